@@ -0,0 +1,86 @@
+import sys
+import torch
+from sdbpa_core import SDBPA
+from sdbpa_backends import DataParallelBackend
+
+def benchmark(n_per_prompt=8, max_tokens=150, batch_size=32):
+    """
+    Generation throughput of the static and continuous-batching schedulers
+    on the same S-DBPA style workload (persona paraphrases x John template).
+    """
+    sdbpa = SDBPA()
+    john_template = sdbpa.get_john_prompt_template()
+
+    persona = "Act as a doctor."
+    variants = sdbpa.generate_variations(persona, n=10, temperature=0.9)
+    prompts = [john_template.format(prefix=p + " ") for p in [persona] + variants]
+    print(f"\n--- {len(prompts)} prompts x {n_per_prompt} samples, max_tokens={max_tokens} ---")
+
+    results = {}
+    for scheduler in ["static", "continuous"]:
+        torch.manual_seed(0)
+        responses = sdbpa.get_responses(prompts, n_per_prompt=n_per_prompt, max_tokens=max_tokens,
+                                        batch_size=batch_size, scheduler=scheduler)
+        stats = sdbpa.last_generation_stats
+        results[scheduler] = stats
+        print(f"{scheduler}: {len(responses)} responses, {stats['generated_tokens']} tokens "
+              f"in {stats['generation_seconds']:.1f}s ({stats['tokens_per_sec']:.1f} tok/s)")
+
+    speedup = results["continuous"]["tokens_per_sec"] / max(results["static"]["tokens_per_sec"], 1e-9)
+    print(f"\nContinuous / static throughput: {speedup:.2f}x")
+
+def benchmark_replicas(replica_counts=(1, 2, 4), n_per_prompt=64, max_tokens=150, batch_size=16):
+    """
+    CPU throughput of data-parallel replicas (cores split evenly between
+    them) on the neutral John prompt; ideal scaling is linear in replicas
+    until memory bandwidth saturates.
+    """
+    sdbpa = SDBPA(backend="stub", load_embedder=False)
+    prompt = sdbpa.get_john_prompt_template().format(prefix="")
+
+    base = None
+    for n in replica_counts:
+        with DataParallelBackend(n_replicas=n) as backend:
+            torch.manual_seed(0)
+            backend.get_responses([prompt], n_per_prompt=n_per_prompt, max_tokens=max_tokens,
+                                  batch_size=batch_size)
+            tps = backend.last_generation_stats["tokens_per_sec"]
+        base = base or tps
+        print(f"{n} replicas: {tps:.1f} tok/s ({tps / base:.2f}x, ideal {n}x)")
+
+def benchmark_assisted(n_per_prompt=32, max_tokens=150, batch_size=32):
+    """
+    Assisted (speculative) decoding with the draft model against plain
+    sampling, both one sequence at a time (what assisted decoding runs) and
+    batched (the default path), on the neutral John prompt. Like the
+    assisted run, the batch-1 baseline prefills the full prompt for every
+    sample instead of reusing its cached KV.
+    """
+    sdbpa = SDBPA()
+    prompt = sdbpa.get_john_prompt_template().format(prefix="")
+    sdbpa.load_draft_model()
+
+    runs = {
+        "plain, batch 1": dict(batch_size=1, share_prefill=False, reuse_prefix=False),
+        f"plain, batch {batch_size}": dict(batch_size=batch_size),
+        "assisted": dict(batch_size=1, assisted=True),
+    }
+    tps = {}
+    for name, options in runs.items():
+        torch.manual_seed(0)
+        sdbpa.get_responses([prompt], n_per_prompt=n_per_prompt, max_tokens=max_tokens, **options)
+        tps[name] = sdbpa.last_generation_stats["tokens_per_sec"]
+        print(f"{name}: {tps[name]:.1f} tok/s")
+    stats = sdbpa.last_generation_stats["assisted"]
+    print(f"\nAcceptance rate: {stats['acceptance_rate']:.1%} "
+          f"({stats['tokens_per_target_forward']:.2f} tokens per main-model forward)")
+    for name in list(runs)[:2]:
+        print(f"Speedup vs {name}: {tps['assisted'] / max(tps[name], 1e-9):.2f}x")
+
+if __name__ == "__main__":
+    if "--replicas" in sys.argv:
+        benchmark_replicas()
+    elif "--assisted" in sys.argv:
+        benchmark_assisted()
+    else:
+        benchmark()
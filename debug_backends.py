@@ -0,0 +1,75 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sdbpa_backends import OpenAIBackend, StubBackend
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI-compatible /v1/chat/completions endpoint. Every
+    `fail_every`-th request gets a 503 so the client's retry path runs.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    fail_every = 5
+    lock = threading.Lock()
+    requests = 0
+    clients = set()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            MockChatHandler.requests += 1
+            MockChatHandler.clients.add(self.client_address)
+            n = MockChatHandler.requests
+        if n % self.fail_every == 0:
+            self._reply(503, {"error": "overloaded"}, {"Retry-After": "0"})
+            return
+        prompt = body["messages"][-1]["content"]
+        words = f"mock answer to {prompt}".split()[: body["max_tokens"]]
+        self._reply(200, {
+            "choices": [{"message": {"role": "assistant", "content": " ".join(words)},
+                         "finish_reason": "stop"}],
+            "usage": {"completion_tokens": len(words)},
+        })
+
+    def _reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def test():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockChatHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    print(f"Mock server at {url}")
+
+    prompts = ["Act as a doctor. John has these features...", "John has these features..."]
+    backend = OpenAIBackend(url, model="mock", max_concurrency=4, backoff=0.01)
+    batches = []
+    responses, sources = backend.get_responses(prompts, n_per_prompt=25, max_tokens=10, batch_size=8,
+                                               on_batch=lambda r, s: batches.append(len(r)))
+    print("Stats:", backend.last_generation_stats)
+    print(f"Server saw {MockChatHandler.requests} requests on {len(MockChatHandler.clients)} connections")
+    print("Batches:", batches)
+    assert len(responses) == 50 and sources == [0] * 25 + [1] * 25
+    assert all(r.startswith("mock answer to") for r in responses)
+    print("Variations:", backend.complete([{"role": "user", "content": "Instruction: Act as a doctor."}], 16))
+    server.shutdown()
+
+    stub = StubBackend(seed=0)
+    first, _ = stub.get_responses(prompts, n_per_prompt=3, max_tokens=20, batch_size=4)
+    again, _ = StubBackend(seed=0).get_responses(prompts, n_per_prompt=3, max_tokens=20, batch_size=4)
+    assert first == again
+    print("Stub:", first[0])
+    print("Stub variations:", stub.complete([{"role": "user", "content": "Instruction: Act as a doctor."}], 64))
+
+if __name__ == "__main__":
+    test()
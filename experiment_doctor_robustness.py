@@ -5,9 +5,12 @@ import numpy as np
 import hashlib
 import re
 from sdbpa_core import SDBPA
+from sdbpa_stats import StreamingJSD
+from sdbpa_pipeline import Pipeline, Stage
 
 # --- Configuration ---
 TARGET_N = 200  # Total samples to reach
+METHOD_NAMES = {"dbpa": "DBPA", "sdbpa": "S-DBPA"}
 # ---------------------
 
 def get_safe_filename(text):
@@ -28,7 +31,7 @@ def load_intermediate(category, identifier):
             return None
     return None
 
-def save_intermediate(category, identifier, responses, embeddings=None):
+def save_intermediate(category, identifier, responses, embeddings=None, sources=None):
     base_dir = "results/data_cache"
     if not os.path.exists(base_dir):
         os.makedirs(base_dir)
@@ -40,6 +43,9 @@ def save_intermediate(category, identifier, responses, embeddings=None):
         "identifier": identifier,
         "responses": responses,
     }
+    if sources is not None:
+        # Source variant of each response, aligned with `responses`
+        data["sources"] = sources
     # We generally rely on re-computing embeddings for the full set
     # but saving them doesn't hurt if we want to skip that step. 
     # For now, we will re-compute to keep logic simple when appending.
@@ -48,6 +54,131 @@ def save_intermediate(category, identifier, responses, embeddings=None):
         json.dump(data, f)
     print(f"    [Checkpoint] Saved {len(responses)} samples to {filename}")
 
+def sorted_indices(order):
+    return sorted(range(len(order)), key=order.__getitem__)
+
+def build_pipeline(sdbpa, reference_embeddings, results):
+    """
+    Generation feeds three stages over bounded queues, so embedding batch k,
+    checkpointing and testing persona j all overlap with generating batch k+1:
+
+      embed      -- compute_embeddings per batch, running JSD vs the reference
+      checkpoint -- append new responses to the persona's checkpoint
+      stats      -- permutation test + CI once a persona is complete
+
+    Messages are ("batch", key, responses, sources, order, is_new) and
+    ("done", key) with key = (category, persona); `state[key]` must be
+    registered before the first message for that key. Batches arrive in
+    scheduler order (e.g. shortest prompt first), so every response carries
+    a sort key and checkpoints and the test sample are put back in that
+    order before anything is cut to TARGET_N. Returns (pipeline, state).
+    """
+    state = {}
+    trackers = {}
+
+    def embed(msg):
+        if msg[0] == "batch":
+            _, key, responses, sources, order, _ = msg
+            st = state[key]
+            embs = sdbpa.compute_embeddings(responses)
+            st["emb_parts"].append(embs)
+            st["emb_sources"].extend(sources)
+            st["emb_order"].extend(order)
+            tracker = trackers.setdefault(key, StreamingJSD(reference_embeddings))
+            jsd = tracker.update(embs)
+            print(f"    [Live] n={tracker.n}, JSD: {jsd:.4f}")
+        return msg
+
+    def checkpoint(msg):
+        if msg[0] == "done":
+            return msg
+        _, (category, persona), responses, sources, order, is_new = msg
+        if is_new:
+            st = state[(category, persona)]
+            st["responses"].extend(responses)
+            st["sources"].extend(sources)
+            st["order"].extend(order)
+            idx = sorted_indices(st["order"])
+            save_intermediate(category, persona, [st["responses"][i] for i in idx],
+                              sources=[st["sources"][i] for i in idx] if category == "sdbpa" else None)
+        return None
+
+    def stats(msg):
+        _, (category, persona) = msg
+        st = state[(category, persona)]
+        idx = sorted_indices(st["emb_order"])[:TARGET_N]
+        emb = np.concatenate(st["emb_parts"])[idx]
+        emb_sources = [st["emb_sources"][i] for i in idx]
+        row = sdbpa.permutation_test_many(reference_embeddings, {persona: emb})[persona]
+        row.update(sdbpa.bootstrap_ci_many(reference_embeddings, {persona: emb})[persona])
+        print(f"  [{METHOD_NAMES[category]}] '{persona}' -> JSD: {row['jsd']:.4f} "
+              f"[{row['ci_lower']:.4f}, {row['ci_upper']:.4f}], p: {row['p_value']:.4f}")
+
+        if category == "sdbpa":
+            # Which paraphrase drives the shift (only responses with a known variant)
+            contributions = sdbpa.variant_contributions(
+                reference_embeddings, emb, emb_sources
+            )
+            if contributions:
+                row["variant_contributions"] = contributions
+                top = max(contributions, key=lambda v: contributions[v]["contribution"])
+                print(f"    Largest contribution: '{top}' ({contributions[top]['contribution']:+.4f})")
+        results[METHOD_NAMES[category]][persona] = row
+
+    pipeline = Pipeline([Stage("embed", embed), Stage("checkpoint", checkpoint), Stage("stats", stats)])
+    return pipeline, state
+
+def run_persona(sdbpa, pipeline, state, category, persona, prompts, variants=None):
+    """
+    Feed one persona's cached responses and new generation batches into the
+    pipeline. `variants[k]` names the source of responses to prompts[k].
+    """
+    cached = load_intermediate(category, persona)
+    current_resps = cached["responses"] if cached else []
+    # Older checkpoints did not record which variant produced each response
+    current_sources = cached.get("sources", [None] * len(current_resps)) if cached else []
+    print(f"  Existing: {len(current_resps)}")
+
+    # Checkpointed responses keep their saved order ahead of new ones
+    cached_order = [(0, i) for i in range(len(current_resps))]
+    key = (category, persona)
+    state[key] = {
+        "responses": list(current_resps),
+        "sources": list(current_sources),
+        "order": list(cached_order),
+        "emb_parts": [],
+        "emb_sources": [],
+        "emb_order": [],
+    }
+    if current_resps:
+        pipeline.submit(("batch", key, current_resps[:TARGET_N], current_sources[:TARGET_N],
+                         cached_order[:TARGET_N], False))
+
+    if len(current_resps) < TARGET_N:
+        needed = TARGET_N - len(current_resps)
+        # Sample roughly equally across the prompts
+        n_per_prompt = max(1, int(np.ceil(needed / len(prompts))))
+        print(f"  Generating ~{needed} samples ({n_per_prompt}/prompt)...")
+
+        # New responses interleave round-robin over the prompts, (sample j,
+        # prompt k), so cutting the surplus of ceil(needed / len(prompts))
+        # per prompt to TARGET_N trims every prompt evenly
+        seen = [0] * len(prompts)
+
+        def on_batch(responses, sources):
+            names = [variants[k] if variants is not None else None for k in sources]
+            order = []
+            for k in sources:
+                order.append((1, seen[k], k))
+                seen[k] += 1
+            pipeline.submit(("batch", key, responses, names, order, True))
+
+        with pipeline.producer("generation"):
+            sdbpa.get_responses(prompts, n_per_prompt=n_per_prompt, on_batch=on_batch)
+    else:
+        print("  Sufficient samples.")
+    pipeline.submit(("done", key))
+
 def run_experiment():
     sdbpa = SDBPA()
     
@@ -93,95 +224,49 @@ def run_experiment():
     
     all_prompts = [baseline_persona] + variations
     
-    # --- PHASE 1: Standard DBPA (Single Prompt) ---
-    print("\n--- Running Standard DBPA (Single Prompt Stability) ---")
-    for persona in all_prompts:
-        print(f"p: '{persona}'")
-        cached = load_intermediate("dbpa", persona)
-        current_resps = cached["responses"] if cached else []
-        
-        print(f"  Existing: {len(current_resps)}")
-        
-        if len(current_resps) < TARGET_N:
-            needed = TARGET_N - len(current_resps)
-            print(f"  Generating {needed} more...")
-            task_prompt = john_template.format(prefix=persona)
-            new_resps = sdbpa.get_responses([task_prompt], n_per_prompt=needed)
-            current_resps.extend(new_resps)
-            save_intermediate("dbpa", persona, current_resps)
-        else:
-             print("  Sufficient samples.")
-        
-        # Analyze
-        current_resps = current_resps[:TARGET_N]
-        embs = sdbpa.compute_embeddings(current_resps)
-        jsd, p_val = sdbpa.permutation_test(neutral_embeddings, embs)
-        
-        results["DBPA"][persona] = {
-            "jsd": float(jsd),
-            "p_value": float(p_val),
-            "n": len(current_resps)
-        }
-        print(f"  -> JSD: {jsd:.4f}, p: {p_val:.4f}")
-
-    # --- PHASE 2: S-DBPA (Semantic Neighborhood) ---
-    print("\n--- Running S-DBPA (Semantic Robustness) ---")
-    
-    neighborhoods = {}
-    
-    # Reuse previous logic for neighborhood generation or cache it?
-    # Neighborhood definition shouldn't change much, but let's regenerate or caching neighbors is better.
-    # For now, regeneration is fast.
-    
-    for persona in all_prompts:
-        print(f"Neighborhood for: '{persona}'")
-        # Optimization: Generate fewer variations if we just want the prompt strings, but we need consistency.
-        # Let's generate 30 variations to ensure better coverage
-        vars_prefix = sdbpa.generate_variations(persona.strip(), n=30)
-        filtered_vars = sdbpa.filter_variations(persona.strip(), vars_prefix, threshold=0.50)
-        final_set = [persona.strip()] + filtered_vars
-        
-        print(f"    [Neighborhood] {final_set}")
-        
-        neighborhood_prompts = [john_template.format(prefix=p + " ") for p in final_set]
-        neighborhoods[persona] = neighborhood_prompts
-    
-    # Execute S-DBPA
-    for persona, prompt_set in neighborhoods.items():
-        print(f"Processing S-DBPA: '{persona}' (Size: {len(prompt_set)})")
+    # Generation runs here; embedding, checkpoints and tests run behind it
+    pipeline, state = build_pipeline(sdbpa, neutral_embeddings, results)
+    with pipeline:
+        # --- PHASE 1: Standard DBPA (Single Prompt) ---
+        print("\n--- Running Standard DBPA (Single Prompt Stability) ---")
+        for persona in all_prompts:
+            print(f"p: '{persona}'")
+            run_persona(sdbpa, pipeline, state, "dbpa", persona, [john_template.format(prefix=persona)])
+
+        # --- PHASE 2: S-DBPA (Semantic Neighborhood) ---
+        print("\n--- Running S-DBPA (Semantic Robustness) ---")
         
-        cached = load_intermediate("sdbpa", persona)
-        current_resps = cached["responses"] if cached else []
+        neighborhoods = {}
+        neighborhood_variants = {}
         
-        print(f"  Existing: {len(current_resps)}")
+        # Reuse previous logic for neighborhood generation or cache it?
+        # Neighborhood definition shouldn't change much, but let's regenerate or caching neighbors is better.
+        # For now, regeneration is fast.
         
-        if len(current_resps) < TARGET_N:
-            needed = TARGET_N - len(current_resps)
-            n_variants = len(prompt_set)
-            # Sample roughly equally
-            # We need 'needed' total.
-            # n_per_variant = needed / n_variants
-            n_per_variant = max(1, int(np.ceil(needed / n_variants)))
-            
-            print(f"  Generating ~{needed} samples ({n_per_variant}/variant)...")
-            rs = sdbpa.get_responses(prompt_set, n_per_prompt=n_per_variant)
+        for persona in all_prompts:
+            print(f"Neighborhood for: '{persona}'")
+            # Optimization: Generate fewer variations if we just want the prompt strings, but we need consistency.
+            # Let's generate 30 variations to ensure better coverage
+            with pipeline.producer("generation"):
+                vars_prefix = sdbpa.generate_variations(persona.strip(), n=30)
+            filtered_vars = sdbpa.filter_variations(persona.strip(), vars_prefix, threshold=0.50)
+            final_set = [persona.strip()] + filtered_vars
             
-            current_resps.extend(rs)
-            save_intermediate("sdbpa", persona, current_resps)
-        else:
-            print("  Sufficient samples.")
+            print(f"    [Neighborhood] {final_set}")
             
-        # Analyze
-        current_resps = current_resps[:TARGET_N] # Clip to exact target for fairness
-        embs = sdbpa.compute_embeddings(current_resps)
-        jsd, p_val = sdbpa.permutation_test(neutral_embeddings, embs)
+            neighborhood_prompts = [john_template.format(prefix=p + " ") for p in final_set]
+            neighborhoods[persona] = neighborhood_prompts
+            neighborhood_variants[persona] = final_set
         
-        results["S-DBPA"][persona] = {
-            "jsd": float(jsd),
-            "p_value": float(p_val),
-            "n": len(current_resps)
-        }
-        print(f"  -> JSD: {jsd:.4f}, p: {p_val:.4f}")
+        # Execute S-DBPA
+        for persona, prompt_set in neighborhoods.items():
+            print(f"Processing S-DBPA: '{persona}' (Size: {len(prompt_set)})")
+            run_persona(sdbpa, pipeline, state, "sdbpa", persona, prompt_set,
+                        variants=neighborhood_variants[persona])
+
+    utilization = pipeline.utilization()
+    print("\n  Stage utilization: " + ", ".join(f"{name} {u:.0%}" for name, u in utilization.items()))
+    results["pipeline_utilization"] = utilization
 
     # Save Final Results
     with open("results/robustness_results.json", "w") as f:
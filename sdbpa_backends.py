@@ -0,0 +1,571 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import queue
+import random
+import ssl
+import time
+import traceback
+from urllib.parse import urlsplit
+
+# --- Backend Configuration ---
+# OpenAI-compatible HTTP client
+OPENAI_MAX_CONCURRENCY = 16  # requests in flight (and pooled keep-alive connections)
+OPENAI_MAX_RETRIES = 4       # per request, with exponential backoff
+OPENAI_BACKOFF = 0.5         # seconds before the first retry
+OPENAI_TIMEOUT = 120.0       # seconds per attempt
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Data-parallel replicas
+REPLICA_START_TIMEOUT = 600.0  # seconds for every replica to load its model
+REPLICA_POLL_INTERVAL = 1.0    # seconds between liveness checks while waiting on replicas
+
+# Deterministic stub
+STUB_MEAN_TOKENS = 40
+STUB_VARIATIONS = 8
+STUB_VOCABULARY = (
+    "patient health risk blood pressure weight exercise diet smoking doctor "
+    "recommend monitor lifestyle changes regular checkups heart sleep stress "
+    "medication screening follow-up advice consider reduce increase maintain"
+).split()
+
+
+class GenerationBackend:
+    """
+    What SDBPA needs from a text generator. `complete` returns one sampled
+    completion of a chat, `get_responses` samples n_per_prompt responses per
+    user prompt and returns (responses, sources) in (prompt, sample) order,
+    calling on_batch(responses, sources) as groups of responses finish.
+    `stop_lines` tells `complete` the caller only needs that many non-empty
+    lines, so backends that can stop decoding early may do so.
+    `options` of get_responses are backend-specific scheduling knobs (HF:
+    share_prefill, scheduler, assisted, ...); a backend ignores the ones it
+    has no counterpart for, so callers can switch backends unchanged.
+    After get_responses, `last_generation_stats` holds throughput and
+    `last_response_metadata[i]` the {"generated_tokens", "eos", "truncated"}
+    of response i.
+    """
+    def __init__(self):
+        self.last_generation_stats = {}
+        self.last_response_metadata = []
+
+    def complete(self, messages, max_tokens, temperature=1.0, stop_lines=None):
+        raise NotImplementedError
+
+    def get_responses(self, prompts, n_per_prompt, max_tokens, batch_size, on_batch=None, **options):
+        raise NotImplementedError
+
+
+class HFBackend(GenerationBackend):
+    """
+    The in-process transformers model of an SDBPA instance, with its prompt
+    caches, length-bucketed / continuous batching and OOM handling.
+    """
+    def __init__(self, sdbpa):
+        self.sdbpa = sdbpa
+
+    @property
+    def last_generation_stats(self):
+        return self.sdbpa.last_generation_stats
+
+    @property
+    def last_response_metadata(self):
+        return self.sdbpa.last_response_metadata
+
+    def complete(self, messages, max_tokens, temperature=1.0, stop_lines=None):
+        return self.sdbpa._hf_complete(messages, max_tokens, temperature, stop_lines=stop_lines)
+
+    def get_responses(self, prompts, n_per_prompt, max_tokens, batch_size, on_batch=None, **options):
+        return self.sdbpa._hf_get_responses(prompts, n_per_prompt, max_tokens, batch_size,
+                                            on_batch=on_batch, **options)
+
+
+class StubBackend(GenerationBackend):
+    """
+    Deterministic generator for tests and benchmarks without weights or a
+    GPU. Responses mix the prompt's words with a fixed vocabulary, so
+    different prompts give different (but reproducible) response
+    distributions. Successive calls continue each prompt's sample sequence
+    instead of repeating it, as a top-up would with a real model.
+    """
+    def __init__(self, seed=0, mean_tokens=STUB_MEAN_TOKENS):
+        super().__init__()
+        self.seed = seed
+        self.mean_tokens = mean_tokens
+        self.drawn = {}  # prompt -> samples generated so far
+
+    def _rng(self, *parts):
+        digest = hashlib.sha256(repr((self.seed,) + parts).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], "little"))
+
+    def _sample(self, prompt, k, max_tokens):
+        rng = self._rng(prompt, k)
+        words = STUB_VOCABULARY + prompt.lower().split()
+        length = 1 + int(rng.expovariate(1.0 / self.mean_tokens))
+        n_tokens = min(length, max_tokens)
+        text = " ".join(rng.choice(words) for _ in range(n_tokens))
+        meta = {"generated_tokens": n_tokens, "eos": length <= max_tokens,
+                "truncated": length > max_tokens}
+        return text, meta
+
+    def complete(self, messages, max_tokens, temperature=1.0, stop_lines=None):
+        # Reorderings of the last line of the request (e.g. the instruction)
+        last_line = messages[-1]["content"].strip().split("\n")[-1]
+        base = last_line.split(":", 1)[-1].split()
+        rng = self._rng(tuple((m["role"], m["content"]) for m in messages))
+        lines = []
+        for _ in range(stop_lines or STUB_VARIATIONS):
+            words = list(base)
+            rng.shuffle(words)
+            lines.append(" ".join(words))
+        return "\n".join(lines)
+
+    def get_responses(self, prompts, n_per_prompt, max_tokens, batch_size, on_batch=None, **options):
+        t0 = time.perf_counter()
+        responses, sources, metadata = [], [], []
+        for idx, p in enumerate(prompts):
+            start = self.drawn.get(p, 0)
+            for k in range(start, start + n_per_prompt):
+                text, meta = self._sample(p, k, max_tokens)
+                responses.append(text)
+                sources.append(idx)
+                metadata.append(meta)
+            self.drawn[p] = start + n_per_prompt
+
+        if on_batch is not None:
+            for i in range(0, len(responses), batch_size):
+                on_batch(responses[i : i + batch_size], sources[i : i + batch_size])
+
+        elapsed = time.perf_counter() - t0
+        tokens = sum(m["generated_tokens"] for m in metadata)
+        self.last_response_metadata = metadata
+        self.last_generation_stats = {
+            "backend": "stub",
+            "generated_tokens": tokens,
+            "generation_seconds": elapsed,
+            "tokens_per_sec": tokens / elapsed if elapsed > 0 else 0.0,
+        }
+        return responses, sources
+
+
+class _ConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections to one host, reused across requests of
+    one event loop. Connections the server closed are discarded on acquire.
+    """
+    def __init__(self, host, port, ssl_context, max_idle):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.max_idle = max_idle
+        self.idle = []
+        self.opened = 0
+
+    async def acquire(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        self.opened += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+
+    def release(self, conn, reusable):
+        if reusable and len(self.idle) < self.max_idle:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self.idle.clear()
+
+
+async def _read_response(reader):
+    """
+    (status, headers, body, keep_alive) of one HTTP/1.1 response.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by server")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = headers.get("connection", "").lower() != "close"
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Trailers end with an empty line
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return status, headers, body, keep_alive
+
+
+class OpenAIBackend(GenerationBackend):
+    """
+    Async client for an OpenAI-compatible /chat/completions endpoint (vLLM,
+    TGI, llama.cpp server, OpenAI). One request per sample, at most
+    `max_concurrency` in flight over pooled keep-alive connections; network
+    errors and retryable statuses (429, 5xx, ...) are retried with
+    exponential backoff, honouring Retry-After. Standard library only.
+
+    get_responses/complete run their own event loop; async callers can use
+    aget_responses/acomplete directly.
+    """
+    def __init__(self, base_url, model, api_key=None, max_concurrency=OPENAI_MAX_CONCURRENCY,
+                 max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT, backoff=OPENAI_BACKOFF):
+        super().__init__()
+        url = urlsplit(base_url)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme: {base_url}")
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl_context = ssl.create_default_context() if url.scheme == "https" else None
+        self.host_header = url.netloc
+        self.path = url.path.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.api_key = api_key if api_key is not None else os.environ.get("OPENAI_API_KEY")
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+
+    def _pool(self):
+        return _ConnectionPool(self.host, self.port, self.ssl_context, self.max_concurrency)
+
+    async def _post(self, pool, payload):
+        body = json.dumps(payload).encode()
+        head = (f"POST {self.path} HTTP/1.1\r\n"
+                f"Host: {self.host_header}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: keep-alive\r\n")
+        if self.api_key:
+            head += f"Authorization: Bearer {self.api_key}\r\n"
+        conn = await pool.acquire()
+        reusable = False
+        try:
+            reader, writer = conn
+            writer.write(head.encode("latin-1") + b"\r\n" + body)
+            await writer.drain()
+            status, headers, data, reusable = await _read_response(reader)
+        finally:
+            pool.release(conn, reusable)
+        return status, headers, data
+
+    async def _chat(self, pool, limit, stats, messages, max_tokens, temperature):
+        payload = {"model": self.model, "messages": messages,
+                   "max_tokens": max_tokens, "temperature": temperature}
+        async with limit:
+            for attempt in range(self.max_retries + 1):
+                delay = self.backoff * 2 ** attempt
+                try:
+                    stats["requests"] += 1
+                    status, headers, data = await asyncio.wait_for(self._post(pool, payload), self.timeout)
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    error = e
+                else:
+                    if status == 200:
+                        return json.loads(data)
+                    error = RuntimeError(f"HTTP {status}: {data[:200]!r}")
+                    if status not in RETRY_STATUS:
+                        raise error
+                    if "retry-after" in headers:
+                        try:
+                            delay = float(headers["retry-after"])
+                        except ValueError:
+                            pass
+                if attempt < self.max_retries:
+                    stats["retries"] += 1
+                    print(f"    [HTTP] {error!r}; retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        raise RuntimeError(f"Request failed after {self.max_retries} retries") from error
+
+    @staticmethod
+    def _parse(data):
+        choice = data["choices"][0]
+        text = (choice.get("message") or {}).get("content") or ""
+        finish = choice.get("finish_reason")
+        tokens = (data.get("usage") or {}).get("completion_tokens")
+        meta = {"generated_tokens": tokens, "eos": finish == "stop", "truncated": finish == "length"}
+        return text.strip(), meta
+
+    async def acomplete(self, messages, max_tokens, temperature=1.0):
+        pool = self._pool()
+        stats = {"requests": 0, "retries": 0}
+        try:
+            data = await self._chat(pool, asyncio.Semaphore(1), stats, messages, max_tokens, temperature)
+        finally:
+            await pool.close()
+        return self._parse(data)[0]
+
+    def complete(self, messages, max_tokens, temperature=1.0, stop_lines=None):
+        # The chat API has no line-count stop; the caller truncates
+        return asyncio.run(self.acomplete(messages, max_tokens, temperature))
+
+    async def aget_responses(self, prompts, n_per_prompt, max_tokens, batch_size, on_batch=None,
+                             temperature=1.0):
+        work_sources = [idx for idx in range(len(prompts)) for _ in range(n_per_prompt)]
+        results = [None] * len(work_sources)
+        metadata = [None] * len(work_sources)
+        pending = []
+        pool = self._pool()
+        limit = asyncio.Semaphore(self.max_concurrency)
+        stats = {"requests": 0, "retries": 0}
+
+        def flush():
+            if on_batch is not None:
+                on_batch([results[i] for i in pending], [work_sources[i] for i in pending])
+            pending.clear()
+
+        async def one(i):
+            messages = [{"role": "user", "content": prompts[work_sources[i]]}]
+            data = await self._chat(pool, limit, stats, messages, max_tokens, temperature)
+            results[i], metadata[i] = self._parse(data)
+            pending.append(i)
+            if len(pending) >= batch_size:
+                flush()
+
+        t0 = time.perf_counter()
+        try:
+            await asyncio.gather(*(one(i) for i in range(len(work_sources))))
+        finally:
+            await pool.close()
+        if pending:
+            flush()
+        elapsed = time.perf_counter() - t0
+
+        tokens = sum(m["generated_tokens"] or 0 for m in metadata)
+        self.last_response_metadata = metadata
+        self.last_generation_stats = {
+            "backend": "openai",
+            "generated_tokens": tokens,
+            "generation_seconds": elapsed,
+            "tokens_per_sec": tokens / elapsed if elapsed > 0 else 0.0,
+            "requests": stats["requests"],
+            "retries": stats["retries"],
+            "connections_opened": pool.opened,
+        }
+        print(f"  > {len(results)} responses in {elapsed:.1f}s via {self.host_header} "
+              f"({stats['requests']} requests, {stats['retries']} retries, "
+              f"{pool.opened} connections)")
+        return results, work_sources
+
+    def get_responses(self, prompts, n_per_prompt, max_tokens, batch_size, on_batch=None,
+                      temperature=1.0, **options):
+        return asyncio.run(self.aget_responses(prompts, n_per_prompt, max_tokens, batch_size,
+                                               on_batch=on_batch, temperature=temperature))
+
+
+def hf_replica(device, num_threads):
+    """
+    Default DataParallelBackend replica: an in-process HF SDBPA without the
+    embedder. Imported lazily so the parent never loads generator weights.
+    """
+    from sdbpa_core import SDBPA
+    return SDBPA(device=device, num_threads=num_threads, load_embedder=False)
+
+
+def _replica_worker(rank, device, num_threads, cores, factory, tasks, results):
+    """
+    Worker process: pin to `cores`, build a replica and serve tasks until a
+    None sentinel arrives. Every message is (kind, call_id, chunk_id, rank, payload).
+    """
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # Cap the native thread pools before torch starts them
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(num_threads)
+    try:
+        replica = factory(device=device, num_threads=num_threads)
+    except Exception:
+        results.put(("error", None, None, rank, traceback.format_exc()))
+        return
+    results.put(("ready", None, None, rank, os.getpid()))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        kind, call_id, chunk_id, args = task
+        try:
+            if kind == "complete":
+                payload = replica.backend.complete(*args)
+            else:
+                prompts, max_tokens, batch_size, options = args
+                # One entry per work item; identical prompts share their KV prefix
+                responses = replica.get_responses(prompts, n_per_prompt=1, max_tokens=max_tokens,
+                                                  batch_size=batch_size, **options)
+                payload = (responses, replica.last_response_metadata,
+                           replica.last_generation_stats.get("generated_tokens", 0))
+            results.put(("done", call_id, chunk_id, rank, payload))
+        except Exception:
+            results.put(("error", call_id, chunk_id, rank, traceback.format_exc()))
+
+
+class DataParallelBackend(GenerationBackend):
+    """
+    N worker processes, each with its own model replica (built by `factory`,
+    HF by default) pinned to a disjoint set of `threads_per_replica` cores.
+    Work items are cut into chunks of batch_size and pulled from one shared
+    queue, so faster replicas take more chunks; results are merged back in
+    (prompt, sample) order and each response's metadata records the replica
+    that produced it. Replicas stay loaded across calls until close().
+    """
+    def __init__(self, n_replicas=2, devices=None, threads_per_replica=None, factory=hf_replica):
+        super().__init__()
+        self.devices = list(devices) if devices is not None else ["cpu"] * n_replicas
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+        if threads_per_replica is None:
+            threads_per_replica = max(1, len(cores) // len(self.devices))
+        self.threads_per_replica = threads_per_replica
+
+        # spawn: CUDA and torch thread pools do not survive fork
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = []
+        for rank, device in enumerate(self.devices):
+            pinned = cores[rank * threads_per_replica : (rank + 1) * threads_per_replica]
+            if len(pinned) < threads_per_replica:
+                pinned = None  # More threads than cores: leave scheduling to the OS
+            worker = ctx.Process(
+                target=_replica_worker,
+                args=(rank, device, threads_per_replica, pinned, factory, self.tasks, self.results),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        self.call_id = 0
+
+        self.pids = {}
+        deadline = time.monotonic() + REPLICA_START_TIMEOUT
+        try:
+            while len(self.pids) < len(self.workers):
+                kind, _, _, rank, payload = self._next_message(deadline)
+                if kind == "error":
+                    raise RuntimeError(f"Replica {rank} failed to start:\n{payload}")
+                self.pids[rank] = payload
+        except Exception:
+            self.close()
+            raise
+        print(f"  Data-parallel: {len(self.workers)} replicas x {threads_per_replica} threads "
+              f"on {self.devices}")
+
+    def _next_message(self, deadline=None):
+        """
+        Next worker message. Between polls the replicas are checked for
+        liveness: a replica killed mid-task (e.g. by the OOM killer) never
+        reports its chunk, so waiting on the queue alone would block forever.
+        """
+        while True:
+            try:
+                return self.results.get(timeout=REPLICA_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            for rank, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    raise RuntimeError(f"Replica {rank} (pid {worker.pid}) died "
+                                       f"with exit code {worker.exitcode}")
+            if deadline is not None and time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for replicas")
+
+    def _results(self, call_id):
+        """Messages of the current call; stale ones from a failed call are dropped."""
+        while True:
+            kind, msg_call, chunk_id, rank, payload = self._next_message()
+            if msg_call != call_id:
+                continue
+            if kind == "error":
+                raise RuntimeError(f"Replica {rank} failed:\n{payload}")
+            yield chunk_id, rank, payload
+
+    def complete(self, messages, max_tokens, temperature=1.0, stop_lines=None):
+        self.call_id += 1
+        self.tasks.put(("complete", self.call_id, 0, (messages, max_tokens, temperature, stop_lines)))
+        _, _, text = next(self._results(self.call_id))
+        return text
+
+    def get_responses(self, prompts, n_per_prompt, max_tokens, batch_size, on_batch=None, **options):
+        self.call_id += 1
+        work_sources = [idx for idx in range(len(prompts)) for _ in range(n_per_prompt)]
+        chunks = [list(range(i, min(i + batch_size, len(work_sources))))
+                  for i in range(0, len(work_sources), batch_size)]
+        t0 = time.perf_counter()
+        for chunk_id, chunk in enumerate(chunks):
+            shard = [prompts[work_sources[i]] for i in chunk]
+            self.tasks.put(("generate", self.call_id, chunk_id, (shard, max_tokens, batch_size, options)))
+
+        results = [None] * len(work_sources)
+        metadata = [None] * len(work_sources)
+        tokens = {rank: 0 for rank in range(len(self.workers))}
+        received = self._results(self.call_id)
+        for done in range(len(chunks)):
+            chunk_id, rank, (responses, chunk_meta, chunk_tokens) = next(received)
+            chunk = chunks[chunk_id]
+            for i, response, meta in zip(chunk, responses, chunk_meta):
+                results[i] = response
+                metadata[i] = dict(meta, replica=rank, pid=self.pids[rank])
+            tokens[rank] += chunk_tokens
+            if on_batch is not None:
+                on_batch(responses, [work_sources[i] for i in chunk])
+            print(f"    Chunk {done + 1}/{len(chunks)} done on replica {rank}.")
+        elapsed = time.perf_counter() - t0
+
+        total = sum(tokens.values())
+        self.last_response_metadata = metadata
+        self.last_generation_stats = {
+            "backend": "data_parallel",
+            "replicas": len(self.workers),
+            "threads_per_replica": self.threads_per_replica,
+            "generated_tokens": total,
+            "generation_seconds": elapsed,
+            "tokens_per_sec": total / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_replica": tokens,
+        }
+        print(f"  > Generated {total} tokens in {elapsed:.1f}s "
+              f"({self.last_generation_stats['tokens_per_sec']:.1f} tok/s on {len(self.workers)} replicas)")
+        return results, work_sources
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
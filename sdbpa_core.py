@@ -1,3 +1,7 @@
+import os
+import copy
+import time
+from collections import deque
 import torch
 import numpy as np
 import random
@@ -5,88 +9,206 @@ import gc
 import re
 from tqdm import tqdm
 from scipy.spatial.distance import jensenshannon
-from scipy.stats import norm
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList, pipeline
 from sentence_transformers import SentenceTransformer
+from sdbpa_stats import (
+    batched_permutation_test, sequential_permutation_test, multi_target_permutation_test,
+    multi_target_bootstrap_ci, asymptotic_test, PooledSample, SlicedJSD,
+    variant_contributions,
+    DEFAULT_CHUNK_SIZE
+)
+from sdbpa_backends import GenerationBackend, HFBackend, StubBackend
+from sdbpa_generation import (
+    PrefixCache, expand_prompt_cache, common_prefix_length,
+    length_bucketed_batches, padding_ratio, AdaptiveBatchSizer, is_oom_error,
+    ContinuousBatcher, sampling_processors, generation_metadata, TemplateCache, ForwardCounter,
+    LineCountStopping, eos_token_ids, PREFIX_CACHE_BYTES
+)
 
 # --- Configuration ---
 # Models
 GEN_MODEL_ID = "Qwen/Qwen2.5-1.5B-Instruct"
+# Draft for assisted (speculative) decoding: same family, so same tokenizer
+DRAFT_MODEL_ID = "Qwen/Qwen2.5-0.5B-Instruct"
 EMBED_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
 
 # Experiment Settings
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Using device: {DEVICE}")
 
+# Paraphrase generation: extra requests for the paraphrases still missing
+VARIATION_ROUNDS = 3
+
+# CPU execution: dynamic int8 quantization of the Linear layers (needs fp32 weights)
+CPU_QUANTIZE = False
+
+
+def clean_variation_line(line):
+    """
+    A generated paraphrase line without numbering ("1. ", "1)", "11.") or
+    bullets; empty if nothing is left.
+    """
+    line = line.strip()
+    # Remove leading numbering
+    line = re.sub(r'^\d+[\.\)]\s*', '', line)
+    # Remove leading bullets
+    line = re.sub(r'^[\-\*]\s*', '', line)
+    return line
+
+
+def load_causal_lm(model_id, device, dtype, quantize=False):
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id, 
+        trust_remote_code=True, 
+        torch_dtype=dtype, 
+        device_map=device,
+        low_cpu_mem_usage=True
+    )
+    if device == "cpu" and quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def cpu_generation_dtype():
+    """
+    bf16 only where the CPU has native bf16 kernels; emulated bf16 is slower than fp32.
+    """
+    try:
+        if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            return torch.bfloat16
+    except Exception:
+        pass
+    return torch.float32
+
+
+def configure_cpu_threads(num_threads=None):
+    """
+    Pin torch intra-op threads to the cores available to this process.
+    """
+    if num_threads is None:
+        try:
+            num_threads = len(os.sched_getaffinity(0))
+        except AttributeError:
+            num_threads = os.cpu_count() or 1
+    torch.set_num_threads(num_threads)
+    try:
+        # Generation is a single op stream; extra inter-op threads only contend
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Already set once in this process
+    return num_threads
+
+
 class SDBPA:
-    def __init__(self):
+    def __init__(self, device=DEVICE, quantize=CPU_QUANTIZE, num_threads=None,
+                 prefix_cache_bytes=PREFIX_CACHE_BYTES, backend="hf", load_embedder=True):
+        """
+        `backend` selects who generates text: "hf" loads GEN_MODEL_ID in
+        process, "stub" is the deterministic StubBackend, and any
+        GenerationBackend instance (e.g. OpenAIBackend for an inference
+        server, DataParallelBackend for replicas) is used as is. Only "hf"
+        loads generator weights. Generation-only replicas pass
+        load_embedder=False.
+        """
         print("Loading models (Optimized for Speed & 16GB RAM)...")
+        self.device = device
+        if device == "cpu":
+            threads = configure_cpu_threads(num_threads)
+            dtype = torch.float32 if quantize else cpu_generation_dtype()
+            print(f"  CPU mode: {threads} threads, dtype={dtype}, int8={quantize}")
+        else:
+            dtype = torch.float16
+        self.dtype = dtype
+        self.quantize = quantize
+        # Loaded on first assisted get_responses call (see load_draft_model)
+        self.draft_model = None
+        self.forward_counters = None
+
         # 1. Paraphraser / Subject Model (Qwen-1.5B)
-        self.tokenizer = AutoTokenizer.from_pretrained(GEN_MODEL_ID, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            GEN_MODEL_ID, 
-            trust_remote_code=True, 
-            torch_dtype=torch.float16, 
-            device_map="cuda",
-            low_cpu_mem_usage=True
-        )
+        if backend == "hf":
+            self.tokenizer = AutoTokenizer.from_pretrained(GEN_MODEL_ID, trust_remote_code=True)
+            # Decoder-only generation continues from the last position: pad on the left
+            self.tokenizer.padding_side = "left"
+            self.model = load_causal_lm(GEN_MODEL_ID, device, dtype, quantize)
+            self.backend = HFBackend(self)
+        elif backend == "stub":
+            self.backend = StubBackend()
+        elif isinstance(backend, GenerationBackend):
+            self.backend = backend
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+        print(f"  Generation backend: {type(self.backend).__name__}")
         
         # 2. Embedder
-        self.embedder = SentenceTransformer(EMBED_MODEL_ID, device=DEVICE)
+        self.embedder = SentenceTransformer(EMBED_MODEL_ID, device=device) if load_embedder else None
+        self.last_generation_stats = {}
+        # Per-response {"generated_tokens", "eos", "truncated"} of the last get_responses call
+        self.last_response_metadata = []
+        # Rendered + tokenized chat prompts, shared by all generation methods
+        self.template_cache = TemplateCache()
+        # KV caches of shared prompt prefixes, reused across batches and calls
+        self.prefix_cache = PrefixCache(max_bytes=prefix_cache_bytes)
+        # Largest batch size that fits, per prompt length
+        self.batch_sizer = AdaptiveBatchSizer()
         print("Models loaded.")
         
     def clear_cache(self):
+        self.prefix_cache.clear()
+        self.template_cache.clear()
         torch.cuda.empty_cache()
         gc.collect()
 
-    def generate_variations(self, prompt, n=30, temperature=0.9):
+    def generate_variations(self, prompt, n=30, temperature=0.9, max_rounds=VARIATION_ROUNDS):
         """
-        Generate semantic variations of the prompt using Qwen.
+        Generate semantic variations of the prompt with the generation backend.
+        Decoding stops once the requested number of clean lines is out; if
+        fewer than `n` distinct paraphrases came back, up to `max_rounds`
+        requests in total ask for just the missing count.
         """
-        # define chat messages
-        messages = [
-            {"role": "system", "content": "You are a creative writing assistant specialized in semantic paraphrasing."},
-            {"role": "user", "content": (
-                f"Paraphrase the following instruction in {n} different ways. "
-                f"Use diverse wording, including common terms like 'Doctor', 'Physician', 'Medical Professional' where appropriate. "
-                f"Preserve the core semantic intent but explore the full vocabulary space. "
-                f"Output only the list of paraphrases, one per line, no numbering.\n\n"
-                f"Instruction: {prompt}"
-            )}
-        ]
-        
-        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = self.tokenizer(text, return_tensors="pt").to(DEVICE)
-        
-        outputs = self.model.generate(
-            **inputs, 
-            max_new_tokens=1024,
-            do_sample=True,
-            temperature=temperature,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
-        
-        generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        if "assistant\n" in generated_text:
-             generated_text = generated_text.split("assistant\n")[-1]
-        elif "Instruction:" in generated_text:
-             generated_text = generated_text.split("Instruction:")[-1].split("\n", 1)[-1]
-             
-        lines = [line.strip() for line in generated_text.split('\n') if line.strip()]
-        
-        # Robust regex cleaning for "1. ", "1)", "11."
-        clean_lines = []
-        for line in lines:
-            # Remove leading numbering
-            line = re.sub(r'^\d+[\.\)]\s*', '', line)
-            # Remove leading bullets
-            line = re.sub(r'^[\-\*]\s*', '', line)
-            if line:
-                clean_lines.append(line)
+        variations = []
+        seen = {prompt.strip().lower()}
+        raw = 0
+        requests = 0
+        for _ in range(max_rounds):
+            missing = n - len(variations)
+            if missing <= 0:
+                break
+            # define chat messages
+            messages = [
+                {"role": "system", "content": "You are a creative writing assistant specialized in semantic paraphrasing."},
+                {"role": "user", "content": (
+                    f"Paraphrase the following instruction in {missing} different ways. "
+                    f"Use diverse wording, including common terms like 'Doctor', 'Physician', 'Medical Professional' where appropriate. "
+                    f"Preserve the core semantic intent but explore the full vocabulary space. "
+                    f"Output only the list of paraphrases, one per line, no numbering.\n\n"
+                    f"Instruction: {prompt}"
+                )}
+            ]
             
-        print(f"    [Generator] Raw variants: {len(clean_lines)}")
-        return clean_lines[:n]
+            generated_text = self.backend.complete(messages, max_tokens=1024, temperature=temperature,
+                                                   stop_lines=missing)
+            requests += 1
+            
+            clean_lines = [clean_variation_line(line) for line in generated_text.split('\n')]
+            clean_lines = [line for line in clean_lines if line]
+            raw += len(clean_lines)
+            
+            # Deduplicate against the prompt and earlier rounds
+            added = 0
+            for line in clean_lines:
+                key = " ".join(line.lower().split())
+                if key not in seen and len(variations) < n:
+                    seen.add(key)
+                    variations.append(line)
+                    added += 1
+            if added == 0:
+                break
+            
+        print(f"    [Generator] Raw variants: {raw}, distinct: {len(variations)} "
+              f"in {requests} request(s)")
+        return variations
 
     def filter_variations(self, base_prompt, variations, threshold=0.85):
         """
@@ -114,68 +236,366 @@ class SDBPA:
         print(f"    [Filter] Kept {len(filtered)}/{len(variations)}")
         return filtered
 
-    def get_responses(self, prompts, n_per_prompt=20, max_tokens=150, batch_size=32):
+    def _hf_complete(self, messages, max_tokens, temperature=1.0, stop_lines=None):
+        """
+        One sampled completion of `messages` from the in-process model
+        (generated tokens only). With `stop_lines`, decoding ends once that
+        many clean paraphrase lines are complete.
+        """
+        _, ids = self.template_cache.render(self.tokenizer, messages)
+        input_ids = torch.tensor([ids], device=self.device)
+        stopping = None
+        if stop_lines is not None:
+            stopping = StoppingCriteriaList([
+                LineCountStopping(self.tokenizer, input_ids.shape[1], stop_lines, clean_variation_line)
+            ])
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_tokens,
+            do_sample=True,
+            temperature=temperature,
+            pad_token_id=self.tokenizer.eos_token_id,
+            stopping_criteria=stopping
+        )
+        return self.tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def load_draft_model(self, model_id=DRAFT_MODEL_ID):
+        """
+        Load the draft model for assisted decoding (same device, dtype and
+        quantization as the main model) and count forward passes of both,
+        from which get_responses derives the draft acceptance rate.
+        """
+        print(f"  Loading draft model {model_id}...")
+        self.draft_model = load_causal_lm(model_id, self.device, self.dtype, self.quantize)
+        self.forward_counters = {
+            "target": ForwardCounter(self.model),
+            "draft": ForwardCounter(self.draft_model),
+        }
+
+    def prefix_kv(self, prefix_ids):
         """
-        Generate responses with detailed progress logging.
-        Optimized to batch across prompts and samples.
+        Batch-1 KV cache covering exactly `prefix_ids`. The longest prefix
+        already in self.prefix_cache is reused and only the remaining tokens
+        are run through the model; the result is stored for later prompts.
+        Callers must copy (expand_prompt_cache) before generating from it.
         """
-        all_responses = []
+        hit_len, cache = self.prefix_cache.lookup(prefix_ids)
+        if hit_len == len(prefix_ids):
+            return cache
         
-        # Flatten the work: [p1, p1, ..., p2, p2, ...]
-        work_items = []
+        if cache is not None:
+            cache = copy.deepcopy(cache)
+        rest = torch.tensor([prefix_ids[hit_len:]], device=self.device)
+        with torch.no_grad():
+            out = self.model(input_ids=rest, past_key_values=cache, use_cache=True)
+        self.prefix_cache.put(prefix_ids, out.past_key_values)
+        return out.past_key_values
+
+    def get_responses(self, prompts, n_per_prompt=20, max_tokens=150, batch_size=32,
+                      on_batch=None, return_sources=False, **options):
+        """
+        Generate `n_per_prompt` sampled responses per prompt with the
+        generation backend, in (prompt, sample) order.
+        `on_batch`, if given, is called as on_batch(responses, sources) with
+        each finished batch and the prompt index of each response (e.g. to
+        fold them into a StreamingJSD while generation continues). Batches
+        arrive in completion order, not (prompt, sample) order.
+        With `return_sources`, returns (responses, sources) where sources[i]
+        is the index in `prompts` that produced responses[i].
+        self.last_response_metadata[i] holds the generated token count and
+        EOS/truncation flags of responses[i] for cost accounting, and
+        self.last_generation_stats the throughput of the call.
+        `options` are backend specific (HF: share_prefill, scheduler).
+        """
+        responses, sources = self.backend.get_responses(
+            prompts, n_per_prompt=n_per_prompt, max_tokens=max_tokens, batch_size=batch_size,
+            on_batch=on_batch, **options
+        )
+        self.last_generation_stats = self.backend.last_generation_stats
+        self.last_response_metadata = self.backend.last_response_metadata
+        if return_sources:
+            return responses, sources
+        return responses
+
+    def _hf_get_responses(self, prompts, n_per_prompt=20, max_tokens=150, batch_size=32,
+                          on_batch=None, share_prefill=None, scheduler="static", assisted=False,
+                          reuse_prefix=True):
+        """
+        HF backend of get_responses; returns (responses, sources).
+        Responses are the decoded generated tokens only (sliced at the input
+        length), batched across prompts and samples.
+
+        Each unique prompt is rendered and tokenized once. With share_prefill
+        (default: when a prompt has at least `batch_size` samples, as in DBPA),
+        batches hold samples of a single prompt: the prompt is prefilled once
+        and its KV cache expanded for every sampled continuation, instead of
+        prefilling the same prompt once per sample.
+        Otherwise work items are scheduled in buckets of similar token length
+        so paraphrases of very different lengths do not pad each other out;
+        responses are still returned in (prompt, sample) order.
+        Mixed-prompt batches reuse the KV cache of the token prefix their
+        prompts share (chat-template header, system prompt); the differing
+        remainders are left-padded after it. Prefix caches live in
+        self.prefix_cache and are reused across batches and calls;
+        reuse_prefix=False prefills every batch in full instead.
+        A batch that runs out of memory is split in half and retried
+        (self.batch_sizer remembers what fits per prompt length), so every
+        work item is generated; any other error is raised.
+
+        scheduler="continuous" instead decodes through a ContinuousBatcher
+        with `batch_size` slots: finished samples leave the batch and queued
+        work items take their place immediately.
+
+        assisted=True samples with speculative decoding: the draft model
+        (self.draft_model, loaded on first use) proposes tokens and the main
+        model verifies them with the rejection rule of speculative sampling,
+        so responses follow exactly the main model's sampling distribution.
+        HF assisted generation runs one sequence at a time; the acceptance
+        rate and tokens per main-model forward go to last_generation_stats.
+        """
+        if scheduler not in ("static", "continuous"):
+            raise ValueError(f"Unknown scheduler: {scheduler}")
+        generate_kwargs = {}
+        if assisted:
+            if scheduler != "static":
+                raise ValueError("Assisted decoding needs the static scheduler")
+            # Ensemble verification trades exactness for acceptance; the audit needs exactness
+            if getattr(self.model.generation_config, "assistant_ensemble_weight", None) is not None:
+                raise ValueError("assistant_ensemble_weight biases sampling; unset it for assisted decoding")
+            if self.draft_model is None:
+                self.load_draft_model()
+            generate_kwargs["assistant_model"] = self.draft_model
+            forwards_before = {k: c.calls for k, c in self.forward_counters.items()}
+        
+        # Render and tokenize each unique prompt once (memoized across calls)
+        prompt_ids = {}
         for p in prompts:
+            if p not in prompt_ids:
+                _, prompt_ids[p] = self.template_cache.render(self.tokenizer, [{"role": "user", "content": p}])
+        pad_id = self.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.tokenizer.eos_token_id
+        
+        if share_prefill is None:
+            share_prefill = n_per_prompt >= batch_size
+        eos_ids = eos_token_ids(self.model, self.tokenizer)
+        
+        # [p1, p1, ..., p2, p2, ...]
+        work_items = []
+        work_sources = []
+        for idx, p in enumerate(prompts):
             work_items.extend([p] * n_per_prompt)
+            work_sources.extend([idx] * n_per_prompt)
+        
+        # Batches are lists of positions in work_items
+        if scheduler == "continuous":
+            batches = []
+        elif assisted:
+            batches = [[i] for i in range(len(work_items))]
+        elif share_prefill:
+            batches = [
+                list(range(start, min(start + batch_size, end)))
+                for end in range(n_per_prompt, len(work_items) + 1, n_per_prompt)
+                for start in range(end - n_per_prompt, end, batch_size)
+            ]
+        else:
+            batches = length_bucketed_batches([len(prompt_ids[p]) for p in work_items], batch_size)
             
         total_items = len(work_items)
-        print(f"  > Processing {total_items} total generation tasks in batches of {batch_size}...")
+        if scheduler == "continuous":
+            print(f"  > Processing {total_items} total generation tasks "
+                  f"(continuous batching, {batch_size} slots)...")
+        elif assisted:
+            print(f"  > Processing {total_items} total generation tasks one at a time "
+                  f"(assisted decoding)...")
+        else:
+            print(f"  > Processing {total_items} total generation tasks in {len(batches)} batches "
+                  f"(shared prefill: {share_prefill})...")
+        results = [None] * total_items
+        metadata = [None] * total_items
+        n_done = 0
+        total_tokens = 0
+        total_time = 0.0
+        padding_ratios = []
+        retries_before = self.batch_sizer.retries
         
-        for i in range(0, total_items, batch_size):
-            batch_prompts = work_items[i : i + batch_size]
-            
-            # Prepare texts
-            texts = []
-            for p in batch_prompts:
-                 msg = [{"role": "user", "content": p}]
-                 txt = self.tokenizer.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
-                 texts.append(txt)
-            
-            # Tokenize with padding
-            inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(DEVICE)
-            
+        if scheduler == "continuous":
+            total_tokens, total_time = self._continuous_responses(
+                [prompt_ids[p] for p in work_items], work_sources, results, metadata, max_tokens,
+                batch_size, pad_id, on_batch
+            )
+        
+        queue = deque(batches)
+        b = 0
+        while queue:
+            batch = queue.popleft()
+            prompt_len = max(len(prompt_ids[work_items[i]]) for i in batch)
+            size = self.batch_sizer.size_for(prompt_len, len(batch))
+            if size < len(batch):
+                queue.appendleft(batch[size:])
+                batch = batch[:size]
+            inputs = None
             try:
+                t0 = time.perf_counter()
+                rows = [prompt_ids[work_items[i]] for i in batch]
+                # Cache everything the batch shares except at least one token per
+                # row, which generate() needs as uncached input. A single-prompt
+                # batch shares the whole prompt.
+                shared = min(common_prefix_length(rows), min(len(r) for r in rows) - 1)
+                if assisted:
+                    shared = 0  # The draft needs the full prompt, not a cached target prefix
+                elif not reuse_prefix:
+                    shared = 0
+                
+                # [shared prefix | left padding | remainder]
+                width = max(len(r) for r in rows)
+                input_ids = torch.full((len(rows), width), pad_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+                input_ids[:, :shared] = torch.tensor(rows[0][:shared])
+                attention_mask[:, :shared] = 1
+                for r, ids in enumerate(rows):
+                    rest = ids[shared:]
+                    input_ids[r, width - len(rest):] = torch.tensor(rest)
+                    attention_mask[r, width - len(rest):] = 1
+                inputs = {
+                    "input_ids": input_ids.to(self.device),
+                    "attention_mask": attention_mask.to(self.device),
+                }
+                if shared > 0:
+                    inputs["past_key_values"] = expand_prompt_cache(
+                        self.prefix_kv(rows[0][:shared]), len(rows)
+                    )
+                pad_ratio = padding_ratio(attention_mask)
+                
                 outputs = self.model.generate(
                     **inputs,
                     max_new_tokens=max_tokens,
                     do_sample=True,
                     temperature=1.0, 
-                    pad_token_id=self.tokenizer.eos_token_id
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    **generate_kwargs
                 )
-                
-                # Decode
-                for j, out in enumerate(outputs):
-                    full_text = self.tokenizer.decode(out, skip_special_tokens=True)
-                    # Extract response (heuristic based on checking prompt end or 'assistant')
-                    if "assistant" in full_text:
-                        response = full_text.split("assistant")[-1].strip()
-                    else:
-                        # Fallback: remove input prompt from decoded text if possible
-                        # This is tricky with padding. 
-                        # Simple hack: the prompt text is known.
-                        # But decoded prompt might differ slightly from input string.
-                        # Let's trust 'assistant' marker for Qwen.
-                        response = full_text # Return full if pattern fails
-                    all_responses.append(response)
-                    
-                print(f"    Batch {i//batch_size + 1} done. ({len(all_responses)}/{total_items})")
-                
             except Exception as e:
-                print(f"    Error during generation batch {i}: {e}")
-                # Pad with empty strings or retry? 
-                # For robustness, append empty strings to keep alignment? 
-                # No, just skip.
-                pass
+                if not is_oom_error(e):
+                    raise
+                inputs = outputs = None
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                retry_size = self.batch_sizer.on_oom(prompt_len, len(batch))
+                print(f"    Out of memory at batch size {len(batch)} "
+                      f"(prompt length {prompt_len}); retrying at {retry_size}")
+                queue.appendleft(batch)
+                continue
+            
+            elapsed = time.perf_counter() - t0
+            self.batch_sizer.on_success(prompt_len, len(batch))
+            b += 1
+            # Decode only the generated tokens, one call per batch
+            gen_ids = outputs[:, inputs["input_ids"].shape[1]:]
+            batch_meta = generation_metadata(gen_ids, eos_ids, max_tokens)
+            n_tokens = sum(m["generated_tokens"] for m in batch_meta)
+            total_tokens += n_tokens
+            total_time += elapsed
+            
+            batch_responses = [
+                text.strip() for text in self.tokenizer.batch_decode(gen_ids, skip_special_tokens=True)
+            ]
+            for i, response, meta in zip(batch, batch_responses, batch_meta):
+                results[i] = response
+                metadata[i] = meta
+            n_done += len(batch)
+            padding_ratios.append(pad_ratio)
+            if on_batch is not None:
+                on_batch(batch_responses, [work_sources[i] for i in batch])
                 
-        return all_responses
+            print(f"    Batch {b} done. ({n_done}/{total_items}) "
+                  f"[{n_tokens / elapsed:.1f} tok/s, padding {pad_ratio:.0%}]")
+            
+        # Throughput of this call, for sizing CPU/GPU fleets
+        self.last_generation_stats = {
+            "device": self.device,
+            "scheduler": scheduler,
+            "generated_tokens": total_tokens,
+            "generation_seconds": total_time,
+            "tokens_per_sec": total_tokens / total_time if total_time > 0 else 0.0,
+            "padding_ratios": padding_ratios,
+            "mean_padding_ratio": float(np.mean(padding_ratios)) if padding_ratios else 0.0,
+            "oom_retries": self.batch_sizer.retries - retries_before,
+            "batch_sizes": self.batch_sizer.stats()["batch_sizes"],
+        }
+        self.last_generation_stats["prefix_cache"] = self.prefix_cache.stats()
+        if assisted:
+            # Every main-model forward emits one token of its own plus the
+            # draft tokens it accepted; every draft forward proposes one token
+            target = self.forward_counters["target"].calls - forwards_before["target"]
+            drafted = self.forward_counters["draft"].calls - forwards_before["draft"]
+            accepted = max(0, total_tokens - target)
+            self.last_generation_stats["assisted"] = {
+                "target_forwards": target,
+                "draft_forwards": drafted,
+                "acceptance_rate": accepted / drafted if drafted else 0.0,
+                "tokens_per_target_forward": total_tokens / target if target else 0.0,
+            }
+            print(f"  > Assisted: acceptance {self.last_generation_stats['assisted']['acceptance_rate']:.1%}, "
+                  f"{self.last_generation_stats['assisted']['tokens_per_target_forward']:.2f} tokens/forward")
+        self.last_generation_stats["template_cache"] = self.template_cache.stats()
+        print(f"  > Generated {total_tokens} tokens in {total_time:.1f}s "
+              f"({self.last_generation_stats['tokens_per_sec']:.1f} tok/s on {self.device})")
+        print(f"  > Prefix cache: {self.prefix_cache.stats()}")
+        print(f"  > Template cache hit rate: {self.template_cache.stats()['hit_rate']:.1%}")
+        if padding_ratios:
+            print(f"  > Mean padding ratio: {self.last_generation_stats['mean_padding_ratio']:.1%}")
+        
+        if self.last_generation_stats["oom_retries"]:
+            print(f"  > OOM retries: {self.last_generation_stats['oom_retries']} "
+                  f"(batch sizes by prompt length: {self.last_generation_stats['batch_sizes']})")
+        
+        # Back to (prompt, sample) order
+        self.last_response_metadata = metadata
+        return results, work_sources
+
+    def _continuous_responses(self, rows, sources, results, metadata, max_tokens, batch_size, pad_id,
+                              on_batch=None):
+        """
+        Continuous-batching backend of get_responses: fills results[i] and
+        metadata[i] for token ids rows[i], passing finished responses and
+        their sources to `on_batch` in groups of `batch_size`.
+        Returns (tokens, seconds).
+        """
+        eos_ids = eos_token_ids(self.model, self.tokenizer)
+        engine = ContinuousBatcher(
+            self.model, pad_id, eos_ids, max_batch_size=batch_size,
+            processors=sampling_processors(self.model.generation_config, temperature=1.0)
+        )
+        pending = []  # (index, generated ids) finished since the last flush
+        counts = []
+        
+        def flush():
+            texts = self.tokenizer.batch_decode([g for _, g in pending], skip_special_tokens=True)
+            for (i, _), text in zip(pending, texts):
+                results[i] = text.strip()
+            if on_batch is not None:
+                on_batch([results[i] for i, _ in pending], [sources[i] for i, _ in pending])
+            print(f"    {len(counts)}/{len(rows)} done.")
+            pending.clear()
+        
+        def on_finish(i, gen_ids):
+            eos = gen_ids[-1] in eos_ids
+            metadata[i] = {"generated_tokens": len(gen_ids), "eos": eos,
+                           "truncated": not eos and len(gen_ids) >= max_tokens}
+            counts.append(len(gen_ids))
+            pending.append((i, gen_ids))
+            if len(pending) >= batch_size:
+                flush()
+        
+        t0 = time.perf_counter()
+        engine.run(rows, max_tokens, on_finish=on_finish)
+        if pending:
+            flush()
+        elapsed = time.perf_counter() - t0
+        return sum(counts), elapsed
 
     def compute_embeddings(self, texts):
         return self.embedder.encode(texts, normalize_embeddings=True)
@@ -229,20 +649,93 @@ class SDBPA:
         jsd = jensenshannon(hist1, hist2)
         return jsd
 
-    def permutation_test(self, emb1, emb2, n_permutations=1000):
+    def calculate_sliced_jsd(self, emb1, emb2, n_projections=64, directions="random"):
+        """
+        Sliced JSD between two sets of embeddings: the average 1-D histogram
+        JSD over K random or principal projections, with adaptive bin edges
+        (see sdbpa_stats.SlicedJSD). Unlike calculate_jsd, no mass is dropped
+        outside a fixed [0, 1] range.
+        """
+        combined = np.concatenate([emb1, emb2], axis=0)
+        stat = SlicedJSD(PooledSample(combined), n_projections=n_projections,
+                         directions=directions)
+        mask = (np.arange(len(combined)) < len(emb1))[None, :]
+        return stat(mask)[0]
+
+    def permutation_test(self, emb1, emb2, n_permutations=1000, method="batched",
+                         chunk_size=DEFAULT_CHUNK_SIZE, seed=None, alpha=None,
+                         n_jobs=1, backend="thread", statistic=None,
+                         strata=None, strata_mode="within"):
         """
         Calculate p-value using permutation test.
         H0: The two samples come from the same distribution.
         Statistic: JSD(S1, S2).
+
+        method="batched" scores `chunk_size` permutations per vectorized pass
+        (see sdbpa_stats); method="gram" does the same from a Gram matrix
+        computed once, so the null loop no longer scales with embedding
+        dimension; method="loop" is the original one-at-a-time reference.
+
+        If `alpha` is set, the batched/gram modes run sequentially: sampling
+        stops once the p-value is confidently above or below alpha, with
+        n_permutations as the maximum budget. The return value is then
+        (stat, p_value, info) with the permutations used and p-value bounds.
+
+        `n_jobs` > 1 spreads the chunks over a thread/process pool. Chunks use
+        SeedSequence-spawned generators, so a fixed `seed` gives the same
+        p-value for any worker count.
+
+        `statistic` names an entry of sdbpa_stats.STATISTICS ("jsd", "mmd",
+        "energy", ...; default "jsd", or "mmd" for method="asymptotic"). A list of names scores all of them on the same
+        permutations and shared Gram/distance matrices and returns
+        {name: (stat, p_value)}.
+
+        `strata` gives a label per row of [emb1; emb2] (e.g. source prompt of
+        each response); permutations are then restricted within strata or
+        move whole strata between groups (strata_mode="within"/"between").
+
+        method="asymptotic" skips permutations and returns a Gamma
+        moment-matched p-value for kernel statistics ("mmd", "energy");
+        see sdbpa_stats.calibrate_asymptotic for its deviation from permutations.
         """
+        if statistic is None:
+            statistic = "mmd" if method == "asymptotic" else "jsd"
+        if method == "asymptotic":
+            return asymptotic_test(emb1, emb2, statistic=statistic)
+        if method in ("batched", "gram"):
+            if method == "gram" and statistic == "jsd":
+                statistic = "jsd_gram"
+            if alpha is not None:
+                return sequential_permutation_test(
+                    emb1, emb2, alpha=alpha, max_permutations=n_permutations,
+                    chunk_size=chunk_size, seed=seed, statistic=statistic,
+                    strata=strata, strata_mode=strata_mode
+                )
+            observed_stat, p_value = batched_permutation_test(
+                emb1, emb2, n_permutations=n_permutations, chunk_size=chunk_size,
+                seed=seed, statistic=statistic, n_jobs=n_jobs, backend=backend,
+                strata=strata, strata_mode=strata_mode
+            )
+            if isinstance(statistic, (list, tuple)):
+                return {
+                    name: (observed_stat[i], p_value[i])
+                    for i, name in enumerate(statistic)
+                }
+            return observed_stat, p_value
+        if method != "loop":
+            raise ValueError(f"Unknown permutation method: {method}")
+        if statistic != "jsd" or strata is not None:
+            raise ValueError("method='loop' only supports the flat 'jsd' test")
+
         observed_stat = self.calculate_jsd(emb1, emb2)
         
         combined = np.concatenate([emb1, emb2], axis=0)
         n1 = len(emb1)
+        rng = np.random.default_rng(seed)
         
         count = 0
         for _ in range(n_permutations):
-            np.random.shuffle(combined)
+            rng.shuffle(combined)
             perm_s1 = combined[:n1]
             perm_s2 = combined[n1:]
             stat = self.calculate_jsd(perm_s1, perm_s2)
@@ -252,6 +745,37 @@ class SDBPA:
         p_value = count / n_permutations
         return observed_stat, p_value
 
+    def permutation_test_many(self, reference, targets, n_permutations=1000,
+                              chunk_size=DEFAULT_CHUNK_SIZE, seed=None):
+        """
+        Permutation-test one reference embedding matrix against a dict of
+        targets in a single vectorized pass (reference-side Gram work done once).
+        Returns {name: {"jsd", "p_value", "n"}}.
+        """
+        return multi_target_permutation_test(
+            reference, targets, n_permutations=n_permutations,
+            chunk_size=chunk_size, seed=seed
+        )
+
+    def bootstrap_ci_many(self, reference, targets, n_resamples=10000, level=0.95,
+                          interval="percentile", seed=None):
+        """
+        Bootstrap confidence intervals for the JSD of one reference against a
+        dict of targets, all resamples scored in batch.
+        Returns {name: {"ci_lower", "ci_upper"}}.
+        """
+        return multi_target_bootstrap_ci(
+            reference, targets, n_resamples=n_resamples, level=level,
+            interval=interval, seed=seed
+        )
+
+    def variant_contributions(self, reference, target, sources):
+        """
+        Per-variant JSD breakdown of a neighborhood sample against the
+        reference; `sources` is the source variant of each target row.
+        """
+        return variant_contributions(reference, target, sources)
+
     def get_john_prompt_template(self):
         # Recreated from read file
         def generate_health_features():
@@ -0,0 +1,500 @@
+import copy
+from collections import OrderedDict, deque
+
+import torch
+from transformers import (
+    DynamicCache, LogitsProcessorList, RepetitionPenaltyLogitsProcessor, StoppingCriteria,
+    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+)
+
+# --- Generation Configuration ---
+# Upper bound on KV memory held by the shared-prefix cache. Qwen2.5-1.5B in
+# fp16 needs ~28 KB per cached token, so this holds thousands of prompt tokens.
+PREFIX_CACHE_BYTES = 256 * 2**20
+# Rendered chat prompts kept by TemplateCache (text + token ids each).
+TEMPLATE_CACHE_SIZE = 4096
+# Consecutive successful batches at one size before the batch size is
+# doubled again (never back to a size that ran out of memory).
+BATCH_GROW_AFTER = 4
+
+
+def eos_token_ids(model, tokenizer):
+    """
+    Every token id generate() stops on: the generation config's
+    eos_token_id, an int or a list (Qwen2.5-Instruct lists both <|im_end|>
+    and <|endoftext|>), falling back to the tokenizer's EOS.
+    """
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    return [eos] if isinstance(eos, int) else list(eos)
+
+
+def count_generated_tokens(gen_ids, eos_token_id):
+    """
+    Tokens actually generated per sequence: everything up to and including
+    the first EOS (later positions are padding). `eos_token_id` is an id or
+    a list of ids, any of which ends a sequence.
+    """
+    is_eos = torch.isin(gen_ids, torch.as_tensor(eos_token_id, device=gen_ids.device))
+    before_eos = (is_eos.cumsum(dim=1) == 0).sum(dim=1)
+    return before_eos + is_eos.any(dim=1).long()
+
+
+def generation_metadata(gen_ids, eos_token_id, max_new_tokens):
+    """
+    Per-sample cost metadata for a batch of generated ids (prompt already
+    sliced off): tokens generated (EOS included), whether the sample ended
+    with EOS, and whether it was cut off at max_new_tokens instead.
+    """
+    is_eos = torch.isin(gen_ids, torch.as_tensor(eos_token_id, device=gen_ids.device))
+    counts = count_generated_tokens(gen_ids, eos_token_id).tolist()
+    eos = is_eos.any(dim=1).tolist()
+    return [
+        {"generated_tokens": int(n), "eos": bool(e), "truncated": not e and n >= max_new_tokens}
+        for n, e in zip(counts, eos)
+    ]
+
+
+def expand_prompt_cache(cache, n):
+    """
+    Copy a batch-1 prompt KV cache to batch n (one row per sampled
+    continuation), leaving the original intact for the next batch.
+    """
+    if hasattr(cache, "batch_repeat_interleave"):
+        cache = copy.deepcopy(cache)
+        cache.batch_repeat_interleave(n)
+        return cache
+    # Legacy tuple-of-(key, value) caches
+    return cache_from_tensors([
+        (k.repeat_interleave(n, dim=0), v.repeat_interleave(n, dim=0)) for k, v in cache
+    ])
+
+
+def cache_tensors(cache):
+    """
+    Per-layer (key, value) tensors of a KV cache, shaped (batch, heads, seq, dim).
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [tuple(kv) for kv in cache]
+
+
+def cache_from_tensors(kv):
+    """
+    DynamicCache holding the given per-layer (key, value) tensors.
+    """
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(kv))
+    return DynamicCache(kv)
+
+
+def cache_nbytes(cache):
+    tensors = [t for kv in cache_tensors(cache) for t in kv]
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+def common_prefix_length(sequences):
+    """
+    Length of the longest token prefix shared by all sequences.
+    """
+    if not sequences:
+        return 0
+    first = sequences[0]
+    length = min(len(seq) for seq in sequences)
+    for seq in sequences[1:]:
+        i = 0
+        while i < length and seq[i] == first[i]:
+            i += 1
+        length = i
+    return length
+
+
+def length_bucketed_batches(lengths, batch_size):
+    """
+    Group work items of similar token length into batches. Items are ordered
+    by length (stable, so equal prompts stay together) and cut into
+    consecutive batches of at most `batch_size`; each batch is a list of
+    indices into `lengths`. Padding is then bounded by the length spread
+    inside one bucket rather than across the whole neighborhood.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def padding_ratio(attention_mask):
+    """
+    Fraction of a padded batch that is pad tokens.
+    """
+    total = attention_mask.numel()
+    return 1.0 - float(attention_mask.sum()) / total if total else 0.0
+
+
+class PrefixCache:
+    """
+    LRU store of batch-1 KV caches keyed by the token ids they cover.
+    `lookup` returns the longest stored prefix of a token sequence, so prompts
+    sharing the chat-template header (or an identical prompt seen in an
+    earlier batch) only prefill their remaining tokens. Entries are evicted
+    least-recently-used first once `max_bytes` of KV tensors is exceeded.
+
+    Only true prefixes are reusable: with causal attention the KV of a shared
+    suffix depends on the differing tokens before it.
+    """
+    def __init__(self, max_bytes=PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # tuple(ids) -> (cache, nbytes)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def lookup(self, ids):
+        ids = tuple(ids)
+        best = None
+        for key in self.entries:
+            if len(key) <= len(ids) and ids[:len(key)] == key:
+                if best is None or len(key) > len(best):
+                    best = key
+        if best is None:
+            self.misses += 1
+            return 0, None
+        self.entries.move_to_end(best)
+        self.hits += 1
+        self.reused_tokens += len(best)
+        return len(best), self.entries[best][0]
+
+    def put(self, ids, cache):
+        key = tuple(ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        nbytes = cache_nbytes(cache)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (cache, nbytes)
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, old_bytes) = self.entries.popitem(last=False)
+            self.total_bytes -= old_bytes
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+            "evictions": self.evictions,
+        }
+
+
+class TemplateCache:
+    """
+    Bounded LRU memo of chat-template rendering and tokenization, keyed by
+    (chat template, messages). A DBPA audit renders one prompt hundreds of
+    times; with the memo the tokenizer runs once per unique prompt.
+    """
+    def __init__(self, max_entries=TEMPLATE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (text, token ids)
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, tokenizer, messages):
+        """
+        (text, token ids) of `messages` under tokenizer's chat template,
+        with the generation prompt appended.
+        """
+        key = (tokenizer.chat_template, tuple((m["role"], m["content"]) for m in messages))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        value = (text, tokenizer(text).input_ids)
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def is_oom_error(e):
+    """
+    True for CUDA out-of-memory and failed (CPU) allocations.
+    """
+    if isinstance(e, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    msg = str(e).lower()
+    return isinstance(e, (RuntimeError, MemoryError)) and (
+        "out of memory" in msg or "can't allocate memory" in msg or isinstance(e, MemoryError)
+    )
+
+
+class AdaptiveBatchSizer:
+    """
+    Per prompt length (rounded up to a power of two), the batch size to run.
+    An out-of-memory batch halves the size and records the failing size as a
+    ceiling; after `grow_after` consecutive successes the size doubles again,
+    staying below the ceiling. State persists across get_responses calls.
+    """
+    def __init__(self, grow_after=BATCH_GROW_AFTER):
+        self.grow_after = grow_after
+        self.sizes = {}      # length key -> current batch size
+        self.ceilings = {}   # length key -> smallest size that ran out of memory
+        self.streaks = {}    # length key -> consecutive successes at current size
+        self.retries = 0
+
+    @staticmethod
+    def length_key(n_tokens):
+        return 1 << max(0, int(n_tokens) - 1).bit_length()
+
+    def size_for(self, n_tokens, requested):
+        return min(requested, self.sizes.get(self.length_key(n_tokens), requested))
+
+    def on_success(self, n_tokens, size):
+        key = self.length_key(n_tokens)
+        self.streaks[key] = self.streaks.get(key, 0) + 1
+        if key in self.sizes and self.streaks[key] >= self.grow_after:
+            grown = min(2 * self.sizes[key], self.ceilings.get(key, float("inf")) - 1)
+            if grown > self.sizes[key]:
+                self.sizes[key] = grown
+                self.streaks[key] = 0
+
+    def on_oom(self, n_tokens, size):
+        """
+        Record an out-of-memory batch of `size`; returns the size to retry with.
+        Raises if a single item does not fit.
+        """
+        if size <= 1:
+            raise RuntimeError(f"Out of memory at batch size 1 (prompt length {n_tokens})")
+        key = self.length_key(n_tokens)
+        self.ceilings[key] = min(size, self.ceilings.get(key, size))
+        self.sizes[key] = size // 2
+        self.streaks[key] = 0
+        self.retries += 1
+        return self.sizes[key]
+
+    def stats(self):
+        return {"oom_retries": self.retries, "batch_sizes": dict(self.sizes)}
+
+
+class ForwardCounter:
+    """
+    Counts forward calls of a module through a permanent forward hook;
+    callers diff `calls` around the work they want to measure.
+    """
+    def __init__(self, module):
+        self.calls = 0
+        self.handle = module.register_forward_hook(self._hook)
+
+    def _hook(self, module, args, output):
+        self.calls += 1
+
+
+class LineCountStopping(StoppingCriteria):
+    """
+    Stop a batch-1 generation once it has emitted `n` complete lines that
+    `clean_line` keeps (non-empty after cleaning). The generated text is
+    only re-decoded when the newest token contains a newline.
+    """
+    def __init__(self, tokenizer, prompt_length, n, clean_line):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.n = n
+        self.clean_line = clean_line
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = False
+        if "\n" in self.tokenizer.decode(input_ids[0, -1:]):
+            text = self.tokenizer.decode(input_ids[0, self.prompt_length:], skip_special_tokens=True)
+            # Only lines terminated by a newline are complete
+            complete = text.rsplit("\n", 1)[0].split("\n")
+            done = sum(1 for line in complete if self.clean_line(line)) >= self.n
+        return torch.full((input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device)
+
+
+def sampling_processors(generation_config, temperature=1.0):
+    """
+    Logits processors equivalent to generate(do_sample=True, temperature=...)
+    under the model's generation_config (repetition penalty, temperature,
+    top-k, top-p, applied in the same order as generate).
+    """
+    processors = LogitsProcessorList()
+    penalty = getattr(generation_config, "repetition_penalty", None)
+    if penalty is not None and penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty))
+    if temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    top_k = getattr(generation_config, "top_k", None)
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k))
+    top_p = getattr(generation_config, "top_p", None)
+    if top_p is not None and top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    return processors
+
+
+class ContinuousBatcher:
+    """
+    Continuous-batching decode loop over an HF causal LM. Up to
+    `max_batch_size` sequences decode together; a sequence leaves the batch
+    as soon as it emits an EOS id (`eos_token_id` may be an id or a list, as
+    in generation_config) or reaches max_new_tokens, and queued prompts
+    are prefilled and merged into the free slots on the next step, so short
+    answers do not hold a slot until the longest one finishes.
+
+    The running batch is kept left-padded: `ids` and `mask` are
+    (batch, length) and the KV cache covers every column of `ids` but the
+    last, which is the next decode input. Rows are merged by left-padding
+    the shorter side (zero keys/values, masked out) and positions come from
+    the attention mask. Logits processors see each row's ids without its
+    left padding (repetition_penalty would otherwise penalize the pad id),
+    so each row decodes as it would alone, up to floating-point differences
+    of the batched forward.
+    """
+    def __init__(self, model, pad_token_id, eos_token_id, max_batch_size=32,
+                 processors=None, do_sample=True):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.eos_token_ids = set([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id)
+        self.max_batch_size = max_batch_size
+        self.processors = processors if processors is not None else LogitsProcessorList()
+        self.do_sample = do_sample
+        self.device = model.device
+        self.steps = 0
+
+    def _left_pad(self, rows):
+        width = max(len(r) for r in rows)
+        ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for r, row in enumerate(rows):
+            ids[r, width - len(row):] = torch.tensor(row)
+            mask[r, width - len(row):] = 1
+        return ids.to(self.device), mask.to(self.device)
+
+    def _next_tokens(self, ids, mask, logits):
+        logits = logits.float()
+        if bool(mask.all()):
+            scores = self.processors(ids, logits)
+        else:
+            scores = torch.cat([
+                self.processors(ids[r : r + 1, mask[r].bool()], logits[r : r + 1])
+                for r in range(len(ids))
+            ])
+        if self.do_sample:
+            return torch.multinomial(torch.softmax(scores, dim=-1), 1)
+        return scores.argmax(dim=-1, keepdim=True)
+
+    def _prefill(self, rows):
+        ids, mask = self._left_pad(rows)
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)
+        with torch.no_grad():
+            out = self.model(input_ids=ids, attention_mask=mask, position_ids=position_ids,
+                             use_cache=True)
+        return ids, mask, out.past_key_values, out.logits[:, -1]
+
+    def _decode(self, ids, mask, cache):
+        position_ids = mask.sum(dim=1, keepdim=True) - 1
+        with torch.no_grad():
+            out = self.model(input_ids=ids[:, -1:], attention_mask=mask, position_ids=position_ids,
+                             past_key_values=cache, use_cache=True)
+        return out.past_key_values, out.logits[:, -1]
+
+    @staticmethod
+    def _slice(ids, mask, cache, rows, start):
+        """Keep `rows` and drop the first `start` columns."""
+        kv = [(k[rows, :, start:], v[rows, :, start:]) for k, v in cache_tensors(cache)]
+        return ids[rows, start:], mask[rows, start:], cache_from_tensors(kv)
+
+    def _merge(self, a, b):
+        """Stack two left-padded (ids, mask, cache) batches."""
+        width = max(a[0].shape[1], b[0].shape[1])
+        padded = []
+        for ids, mask, cache in (a, b):
+            extra = width - ids.shape[1]
+            ids = torch.nn.functional.pad(ids, (extra, 0), value=self.pad_token_id)
+            mask = torch.nn.functional.pad(mask, (extra, 0), value=0)
+            kv = [(torch.nn.functional.pad(k, (0, 0, extra, 0)), torch.nn.functional.pad(v, (0, 0, extra, 0)))
+                  for k, v in cache_tensors(cache)]
+            padded.append((ids, mask, kv))
+        (ids_a, mask_a, kv_a), (ids_b, mask_b, kv_b) = padded
+        kv = [(torch.cat([ka, kb]), torch.cat([va, vb])) for (ka, va), (kb, vb) in zip(kv_a, kv_b)]
+        return torch.cat([ids_a, ids_b]), torch.cat([mask_a, mask_b]), cache_from_tensors(kv)
+
+    def run(self, prompts, max_new_tokens, on_finish=None):
+        """
+        Generate continuations for `prompts` (lists of token ids). Returns the
+        generated ids per prompt, in input order (EOS included when emitted).
+        `on_finish(index, generated_ids)` is called as each prompt finishes.
+        """
+        queue = deque(range(len(prompts)))
+        generated = [[] for _ in prompts]
+        active = []  # prompt index per batch row
+        state = None  # (ids, mask, cache)
+        self.steps = 0
+        
+        while queue or active:
+            new_tokens = []
+            if active:
+                ids, mask, cache = state
+                cache, logits = self._decode(ids, mask, cache)
+                state = (ids, mask, cache)
+                new_tokens.append(self._next_tokens(ids, mask, logits))
+            
+            free = self.max_batch_size - len(active)
+            admitted = [queue.popleft() for _ in range(min(free, len(queue)))]
+            if admitted:
+                ids, mask, cache, logits = self._prefill([prompts[i] for i in admitted])
+                new_tokens.append(self._next_tokens(ids, mask, logits))
+                state = (ids, mask, cache) if state is None else self._merge(state, (ids, mask, cache))
+                active = active + admitted
+            self.steps += 1
+            
+            tokens = torch.cat(new_tokens)
+            ids, mask, cache = state
+            ids = torch.cat([ids, tokens], dim=1)
+            mask = torch.cat([mask, torch.ones_like(tokens)], dim=1)
+            
+            keep = []
+            for row, (i, token) in enumerate(zip(active, tokens[:, 0].tolist())):
+                generated[i].append(token)
+                if token in self.eos_token_ids or len(generated[i]) >= max_new_tokens:
+                    if on_finish is not None:
+                        on_finish(i, generated[i])
+                else:
+                    keep.append(row)
+            
+            if not keep:
+                active, state = [], None
+                continue
+            if len(keep) < len(active):
+                # Drop finished rows and the left-padding columns nobody needs any more
+                rows = torch.tensor(keep, device=mask.device)
+                start = int(mask[rows].any(dim=0).long().argmax())
+                ids, mask, cache = self._slice(ids, mask, cache, rows, start)
+                active = [active[r] for r in keep]
+            state = (ids, mask, cache)
+        
+        return generated
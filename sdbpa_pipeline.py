@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Pipeline Configuration ---
+# Items buffered between two stages. A full queue blocks the upstream stage,
+# so a slow consumer throttles generation instead of piling up batches.
+PIPELINE_QUEUE_SIZE = 4
+
+_STOP = object()
+
+
+class Stage:
+    """
+    One pipeline stage: a worker thread applying `fn` to the items of its
+    inbox and forwarding non-None results to the next stage. Torch and
+    numpy release the GIL in their kernels, so stages overlap with each
+    other and with the producer.
+    """
+    def __init__(self, name, fn, maxsize=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.fn = fn
+        self.inbox = queue.Queue(maxsize=maxsize)
+        self.outbox = None
+        self.busy = 0.0
+        self.items = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=f"stage-{name}", daemon=True)
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                if self.outbox is not None:
+                    self.outbox.put(_STOP)
+                return
+            if self.error is not None:
+                # Keep draining so upstream stages never block on a dead stage
+                continue
+            t0 = time.perf_counter()
+            try:
+                out = self.fn(item)
+            except Exception as e:
+                self.error = e
+                out = None
+            self.busy += time.perf_counter() - t0
+            self.items += 1
+            if out is not None and self.outbox is not None:
+                self.outbox.put(out)
+
+
+class Pipeline:
+    """
+    Linear chain of stages connected by bounded queues. The caller is the
+    producer: `submit` feeds the first stage (blocking when it is full) and
+    raises as soon as any stage has failed, so the producer stops instead of
+    generating work nobody will consume; `close` drains every stage, joins
+    the threads and re-raises the first stage error. Producer time spent inside `producer(name)` blocks is
+    reported alongside the stages in `utilization`.
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        for upstream, downstream in zip(stages, stages[1:]):
+            upstream.outbox = downstream.inbox
+        self.producer_busy = {}
+        self.t_start = None
+        self.wall = None
+
+    def start(self):
+        self.t_start = time.perf_counter()
+        for stage in self.stages:
+            stage.thread.start()
+        return self
+
+    def submit(self, item):
+        self.raise_stage_error()
+        self.stages[0].inbox.put(item)
+
+    def raise_stage_error(self):
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+
+    @contextmanager
+    def producer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.producer_busy[name] = self.producer_busy.get(name, 0.0) + time.perf_counter() - t0
+
+    def close(self):
+        self.stages[0].inbox.put(_STOP)
+        for stage in self.stages:
+            stage.thread.join()
+        self.wall = time.perf_counter() - self.t_start
+        self.raise_stage_error()
+
+    def utilization(self):
+        """
+        Fraction of the pipeline's wall time each stage spent working.
+        """
+        wall = self.wall if self.wall is not None else time.perf_counter() - self.t_start
+        busy = dict(self.producer_busy)
+        busy.update((stage.name, stage.busy) for stage in self.stages)
+        return {name: b / wall if wall > 0 else 0.0 for name, b in busy.items()}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return False
+        # Producer failed: still stop the stages, but report its error
+        try:
+            self.close()
+        except Exception:
+            pass
+        return False
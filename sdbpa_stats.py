@@ -0,0 +1,852 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import jensenshannon
+from scipy.stats import beta, gamma
+
+# --- Statistics Configuration ---
+# Same binning as SDBPA.calculate_jsd: 50 edges over [0, 1] -> 49 bins.
+JSD_BINS = np.linspace(0, 1, 50)
+HIST_EPS = 1e-10
+
+# Permutations evaluated per array pass. Peak memory is roughly
+# chunk_size * (n1 + n2) floats, so 10^5 permutations stay bounded.
+DEFAULT_CHUNK_SIZE = 256
+
+# Sequential mode: total error budget of the p-value confidence sequence,
+# split evenly (Bonferroni) over all interim looks.
+SEQUENTIAL_DELTA = 1e-3
+
+# Neighbours per point for the k-NN JSD estimator (the point itself is added)
+KNN_K = 10
+
+
+def permutation_masks(rng, n, n1, size):
+    """
+    Draw `size` random group assignments at once.
+    Returns a (size, n) boolean matrix; row b is True where sample i goes
+    to the first group. Argsort of uniform keys is a uniform permutation,
+    so `perm < n1` marks a uniform random subset of exactly n1 rows.
+    """
+    perms = np.argsort(rng.random((size, n)), axis=1)
+    return perms < n1
+
+
+class FlatSampler:
+    """
+    Unrestricted permutations of n pooled samples into groups of n1 and n - n1.
+    """
+    def __init__(self, n, n1):
+        self.n = n
+        self.n1 = n1
+
+    def __call__(self, rng, size):
+        return permutation_masks(rng, self.n, self.n1, size)
+
+
+class StratifiedSampler:
+    """
+    Permutations restricted by strata (e.g. the source prompt of each response).
+
+    mode="within": group labels are shuffled inside each stratum, so every
+    stratum keeps its observed group-1/group-2 split. Uniform keys offset by
+    the stratum code sort each row stratum by stratum in random order; a
+    fixed slot pattern then marks the first n1_s slots of stratum s as group 1.
+    At least one stratum must hold rows of both groups; otherwise every
+    permutation reproduces the observed split and the p-value is always 1.
+
+    mode="between": strata move as whole units. Each stratum must lie in one
+    group; the set of group-1 strata is redrawn, so group sizes may vary.
+    Each group needs at least two strata for the redraw to mean anything.
+    """
+    def __init__(self, strata, group1, mode="within"):
+        _, codes = np.unique(np.asarray(strata), return_inverse=True)
+        self.codes = codes
+        self.mode = mode
+        n_strata = codes.max() + 1
+        g1_per_stratum = np.bincount(codes[group1], minlength=n_strata)
+        size_per_stratum = np.bincount(codes, minlength=n_strata)
+        mixed = (g1_per_stratum > 0) & (g1_per_stratum < size_per_stratum)
+
+        if mode == "within":
+            if not mixed.any():
+                raise ValueError("Within-strata permutation needs a stratum holding both groups")
+            starts = np.concatenate([[0], np.cumsum(size_per_stratum)[:-1]])
+            rank = np.arange(len(codes)) - np.repeat(starts, size_per_stratum)
+            self.slot_is_g1 = rank < np.repeat(g1_per_stratum, size_per_stratum)
+        elif mode == "between":
+            if mixed.any():
+                raise ValueError("Between-strata permutation needs every stratum in a single group")
+            self.n_strata = n_strata
+            self.n_g1_strata = int(np.count_nonzero(g1_per_stratum))
+            if min(self.n_g1_strata, n_strata - self.n_g1_strata) < 2:
+                raise ValueError("Between-strata permutation needs at least two strata per group")
+        else:
+            raise ValueError(f"Unknown strata mode: {mode}")
+
+    def __call__(self, rng, size):
+        if self.mode == "within":
+            keys = self.codes[None, :] + rng.random((size, len(self.codes)))
+            order = np.argsort(keys, axis=1)
+            masks = np.empty(order.shape, dtype=bool)
+            np.put_along_axis(masks, order, self.slot_is_g1[None, :], axis=1)
+            return masks
+        unit_g1 = np.argsort(rng.random((size, self.n_strata)), axis=1) < self.n_g1_strata
+        return unit_g1[:, self.codes]
+
+
+def histogram_counts(values, mask, bins=JSD_BINS, weights=None):
+    """
+    Row-wise histogram counts of `values` (B, n), keeping only entries where
+    `mask` is True. All rows are binned with one offset `np.bincount`.
+    Bin assignment matches `np.histogram`: half-open bins, last edge inclusive,
+    values outside [bins[0], bins[-1]] dropped. Optional `weights` (B, n)
+    count each entry with a multiplicity (bootstrap resamples).
+    """
+    n_rows = values.shape[0]
+    n_bins = len(bins) - 1
+    idx = np.searchsorted(bins, values, side="right") - 1
+    idx[values == bins[-1]] = n_bins - 1
+    valid = mask & (idx >= 0) & (idx < n_bins)
+
+    # Offset each row into its own block of n_bins slots
+    offsets = np.broadcast_to(np.arange(n_rows)[:, None] * n_bins, values.shape)
+    flat = offsets[valid] + idx[valid]
+    if weights is not None:
+        weights = weights[valid]
+    counts = np.bincount(flat, weights=weights, minlength=n_rows * n_bins)
+    return counts.reshape(n_rows, n_bins)
+
+
+def histogram_jsd(counts1, counts2, bins=JSD_BINS):
+    """
+    Row-wise JSD between two stacks of histogram counts, reproducing
+    the density / epsilon / normalize steps of SDBPA.calculate_jsd.
+    """
+    widths = np.diff(bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = counts1 / widths / counts1.sum(axis=1, keepdims=True)
+        q = counts2 / widths / counts2.sum(axis=1, keepdims=True)
+    p = p + HIST_EPS
+    q = q + HIST_EPS
+    p /= p.sum(axis=1, keepdims=True)
+    q /= q.sum(axis=1, keepdims=True)
+    return jensenshannon(p, q, axis=1)
+
+
+class PooledSample:
+    """
+    The pooled sample [emb1; emb2] of one test, with the pairwise quantities
+    every statistic needs computed lazily and at most once. Statistics built
+    on the same PooledSample share its Gram and distance matrices.
+    The sample is held in float64: float32 embeddings can move a projection
+    across a histogram bin edge depending on the order of summation, so the
+    batched, Gram and reference paths would disagree on some permutations.
+    """
+    def __init__(self, combined):
+        self.combined = np.asarray(combined, dtype=np.float64)
+        self._gram = None
+        self._dists = None
+
+    def __len__(self):
+        return len(self.combined)
+
+    @property
+    def gram(self):
+        if self._gram is None:
+            self._gram = self.combined @ self.combined.T
+        return self._gram
+
+    @property
+    def dists(self):
+        # Euclidean distances from the Gram matrix: |x|^2 + |y|^2 - 2<x, y>
+        if self._dists is None:
+            sq_norms = np.diag(self.gram)
+            sq = sq_norms[:, None] + sq_norms[None, :] - 2 * self.gram
+            self._dists = np.sqrt(np.maximum(sq, 0))
+            np.fill_diagonal(self._dists, 0)
+        return self._dists
+
+
+def group_weights(masks, dtype):
+    """
+    Averaging weights for both groups: rows of w1 (w2) sum to one over the
+    samples assigned to group 1 (group 2).
+    """
+    w1 = masks.astype(dtype)
+    w2 = (~masks).astype(dtype)
+    w1 /= w1.sum(axis=1, keepdims=True)
+    w2 /= w2.sum(axis=1, keepdims=True)
+    return w1, w2
+
+
+class CentroidJSD:
+    """
+    Centroid-projection histogram JSD (the statistic of SDBPA.calculate_jsd),
+    evaluated for a whole batch of group assignments in a few array ops:
+    one (B, n) @ (n, D) product for the group-1 centroids, one projection of
+    the pooled sample onto every centroid, then offset-bincount histograms.
+    """
+    def __init__(self, sample, bins=JSD_BINS):
+        self.sample = sample
+        self.bins = bins
+
+    def projections(self, masks):
+        # sims[b, i] = <x_i, mean of group 1 under assignment b>
+        combined = self.sample.combined
+        weights = masks.astype(combined.dtype)
+        weights /= weights.sum(axis=1, keepdims=True)
+        centroids = weights @ combined
+        return centroids @ combined.T
+
+    def __call__(self, masks):
+        sims = self.projections(masks)
+        counts1 = histogram_counts(sims, masks, self.bins)
+        counts2 = histogram_counts(sims, ~masks, self.bins)
+        return histogram_jsd(counts1, counts2, self.bins)
+
+
+class GramCentroidJSD(CentroidJSD):
+    """
+    CentroidJSD evaluated from the Gram matrix `combined @ combined.T`,
+    computed once per test. <x_i, centroid_b> is a masked row-sum of the
+    Gram matrix, so each permutation costs O(n^2) regardless of the
+    embedding dimension D.
+    """
+    def projections(self, masks):
+        gram = self.sample.gram
+        weights = masks.astype(gram.dtype)
+        weights /= weights.sum(axis=1, keepdims=True)
+        return weights @ gram
+
+
+class SlicedJSD:
+    """
+    Sliced JSD: project the pooled sample onto K directions in one matmul
+    ("random" unit directions or the top-K "pca" axes), bin each projection
+    with equal-mass edges from the pooled quantiles, and average the K
+    per-direction JSDs. Edges and bin indices are fixed per test, so the
+    group-1 histograms of a whole chunk and all K slices are a single
+    (B, n) @ (n, K * n_bins) product of the masks with a one-hot bin matrix.
+    """
+    def __init__(self, sample, n_projections=64, directions="random", n_bins=20, seed=0):
+        combined = sample.combined
+        dim = combined.shape[1]
+        if directions == "random":
+            rng = np.random.default_rng(seed)
+            dirs = rng.standard_normal((n_projections, dim))
+            dirs /= np.linalg.norm(dirs, axis=1, keepdims=True)
+        elif directions == "pca":
+            centered = combined - combined.mean(axis=0)
+            _, _, vt = np.linalg.svd(centered, full_matrices=False)
+            dirs = vt[:n_projections]
+        else:
+            raise ValueError(f"Unknown projection directions: {directions}")
+        self.directions = dirs.astype(combined.dtype)
+        self.n_bins = n_bins
+
+        proj = combined @ self.directions.T  # (n, K)
+        qs = np.linspace(0, 1, n_bins + 1)[1:-1]
+        inner_edges = np.quantile(proj, qs, axis=0)  # (n_bins - 1, K)
+        idx = (proj[:, :, None] >= inner_edges.T[None, :, :]).sum(axis=2)  # (n, K)
+
+        n, k = idx.shape
+        onehot = np.zeros((n, k, n_bins), dtype=combined.dtype)
+        onehot[np.arange(n)[:, None], np.arange(k)[None, :], idx] = 1
+        self.onehot = onehot.reshape(n, k * n_bins)
+
+    def __call__(self, masks):
+        n_rows = len(masks)
+        w1 = masks.astype(self.onehot.dtype)
+        total = self.onehot.sum(axis=0)
+        counts1 = (w1 @ self.onehot).reshape(n_rows, -1, self.n_bins)
+        counts2 = total.reshape(1, -1, self.n_bins) - counts1
+
+        p = counts1 / counts1.sum(axis=2, keepdims=True) + HIST_EPS
+        q = counts2 / counts2.sum(axis=2, keepdims=True) + HIST_EPS
+        return jensenshannon(p, q, axis=2).mean(axis=1)
+
+
+class KNNJSD:
+    """
+    k-NN Jensen-Shannon divergence (nats) computed in embedding space.
+    A cKDTree over the pooled sample gives each point its k nearest
+    neighbours (plus itself), once per test. Inside that ball the group
+    counts c1, c2 estimate the density ratios p/m and q/m with
+    p ~ c1 / n1, q ~ c2 / n2, m = (p + q) / 2, so
+        JSD ~ 0.5 * mean_{x in S1} log(p/m) + 0.5 * mean_{x in S2} log(q/m).
+    Permutations only relabel points, so the neighbour table is reused and
+    memory stays O(n * k) instead of O(n^2). Being a plug-in estimate it
+    can come out slightly negative when the samples are exchangeable.
+    """
+    def __init__(self, sample, k=KNN_K):
+        combined = sample.combined
+        n = len(combined)
+        tree = cKDTree(combined)
+        _, idx = tree.query(combined, k=k + 1, workers=-1)
+        # With duplicate points the query may return a twin instead of self
+        rows = np.arange(n)
+        missing_self = ~(idx == rows[:, None]).any(axis=1)
+        idx[missing_self, -1] = rows[missing_self]
+        self.neighbours = idx
+        self.k = k
+
+    def __call__(self, masks):
+        n1 = masks.sum(axis=1, keepdims=True)
+        n2 = masks.shape[1] - n1
+        c1 = masks[:, self.neighbours].sum(axis=2)
+        c2 = (self.k + 1) - c1
+        p = c1 / n1
+        q = c2 / n2
+        m = (p + q) / 2
+        with np.errstate(divide="ignore"):
+            log_p = np.where(masks, np.log(p / m), 0)
+            log_q = np.where(~masks, np.log(q / m), 0)
+        return 0.5 * log_p.sum(axis=1) / n1[:, 0] + 0.5 * log_q.sum(axis=1) / n2[:, 0]
+
+
+class GaussianMMD:
+    """
+    Biased (V-statistic) squared MMD with a Gaussian kernel.
+    The bandwidth is the median pairwise distance of the pooled sample, so it
+    is fixed under permutation. For weights w1, w2:
+    MMD^2 = w1'Kw1 + w2'Kw2 - 2 w1'Kw2, all rows of a chunk at once.
+    """
+    def __init__(self, sample, bandwidth=None):
+        dists = sample.dists
+        if bandwidth is None:
+            off_diag = dists[np.triu_indices(len(sample), k=1)]
+            bandwidth = np.median(off_diag)
+        self.bandwidth = bandwidth
+        self.kernel = np.exp(-dists ** 2 / (2 * bandwidth ** 2))
+
+    def __call__(self, masks):
+        w1, w2 = group_weights(masks, self.kernel.dtype)
+        k1 = w1 @ self.kernel
+        k2 = w2 @ self.kernel
+        return (k1 * w1).sum(axis=1) + (k2 * w2).sum(axis=1) - 2 * (k1 * w2).sum(axis=1)
+
+
+class EnergyDistance:
+    """
+    Energy distance 2E|X-Y| - E|X-X'| - E|Y-Y'| (V-statistic form),
+    from the shared pairwise distance matrix.
+    """
+    def __init__(self, sample):
+        self.dists = sample.dists
+        # Energy distance is the MMD of the distance-induced kernel -|x - y|
+        self.kernel = -self.dists
+
+    def __call__(self, masks):
+        w1, w2 = group_weights(masks, self.dists.dtype)
+        d1 = w1 @ self.dists
+        d2 = w2 @ self.dists
+        return 2 * (d1 * w2).sum(axis=1) - (d1 * w1).sum(axis=1) - (d2 * w2).sum(axis=1)
+
+
+# Two-sample statistics selectable by name in SDBPA.permutation_test.
+# Each entry is constructed from a PooledSample and maps (B, n) masks to (B,) values.
+STATISTICS = {
+    "jsd": CentroidJSD,
+    "jsd_gram": GramCentroidJSD,
+    "sliced_jsd": SlicedJSD,
+    "knn_jsd": KNNJSD,
+    "mmd": GaussianMMD,
+    "energy": EnergyDistance,
+}
+
+
+class StatisticBundle:
+    """
+    Several registered statistics on one PooledSample, scored on the same
+    permutations. Returns an (S, B) array, one row per statistic.
+    """
+    def __init__(self, sample, names):
+        self.names = list(names)
+        self.stats = [STATISTICS[name](sample) for name in self.names]
+
+    def __call__(self, masks):
+        return np.stack([stat(masks) for stat in self.stats])
+
+
+def build_statistic(statistic, sample):
+    """
+    Resolve a registry name, a list of names (-> StatisticBundle) or a
+    statistic class into an instance bound to `sample`.
+    """
+    if isinstance(statistic, str):
+        if statistic not in STATISTICS:
+            raise ValueError(f"Unknown statistic: {statistic}")
+        return STATISTICS[statistic](sample)
+    if isinstance(statistic, (list, tuple)):
+        for name in statistic:
+            if name not in STATISTICS:
+                raise ValueError(f"Unknown statistic: {name}")
+        return StatisticBundle(sample, statistic)
+    return statistic(sample)
+
+
+def _setup_test(emb1, emb2, statistic, strata=None, strata_mode="within"):
+    combined = np.concatenate([emb1, emb2], axis=0)
+    n = len(combined)
+    n1 = len(emb1)
+    stat = build_statistic(statistic, PooledSample(combined))
+
+    observed_mask = (np.arange(n) < n1)[None, :]
+    observed_stat = stat(observed_mask)[..., 0][()]
+
+    if strata is None:
+        sampler = FlatSampler(n, n1)
+    else:
+        sampler = StratifiedSampler(strata, observed_mask[0], mode=strata_mode)
+    return stat, sampler, observed_stat
+
+
+def _as_seed_sequence(seed):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def _count_exceedances(stat, sampler, observed_stat, blocks):
+    """
+    Worker task: score a list of (seed_sequence, size) permutation blocks and
+    return how many permuted statistics reach the observed one (one count per
+    statistic for a bundle). Module-level so it can be shipped to a process pool.
+    """
+    count = 0
+    for block_seed, size in blocks:
+        rng = np.random.default_rng(block_seed)
+        masks = sampler(rng, size)
+        count += np.count_nonzero(stat(masks) >= np.asarray(observed_stat)[..., None], axis=-1)
+    return count
+
+
+def batched_permutation_test(emb1, emb2, n_permutations=1000,
+                             chunk_size=DEFAULT_CHUNK_SIZE, seed=None,
+                             statistic="jsd", n_jobs=1, backend="thread",
+                             strata=None, strata_mode="within"):
+    """
+    Permutation test with all permutations of a chunk built as one index
+    matrix and scored in a single vectorized pass.
+    Returns (observed_stat, p_value) with p = #{perm stat >= observed} / n_permutations,
+    the same contract as SDBPA.permutation_test. `statistic` is a STATISTICS
+    name or class; for a list of names both values are arrays in that order,
+    computed on the same permutations and shared pairwise matrices.
+
+    Every chunk draws from its own Generator spawned from SeedSequence(seed),
+    so chunks can be scored in any order. With n_jobs > 1 the chunks are
+    split across a thread or process pool ("thread" / "process") and the
+    counts summed; a given seed yields the same p-value for any n_jobs.
+
+    `strata` (one label per row of [emb1; emb2]) restricts the permutations
+    to StratifiedSampler(strata_mode) instead of free shuffling.
+    """
+    stat, sampler, observed_stat = _setup_test(emb1, emb2, statistic, strata, strata_mode)
+
+    sizes = [min(chunk_size, n_permutations - start)
+             for start in range(0, n_permutations, chunk_size)]
+    blocks = list(zip(_as_seed_sequence(seed).spawn(len(sizes)), sizes))
+
+    if n_jobs == 1 or len(blocks) <= 1:
+        count = _count_exceedances(stat, sampler, observed_stat, blocks)
+    else:
+        n_workers = min(n_jobs, len(blocks))
+        shards = [blocks[w::n_workers] for w in range(n_workers)]
+        pool_cls = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}[backend]
+        with pool_cls(max_workers=n_workers) as pool:
+            futures = [
+                pool.submit(_count_exceedances, stat, sampler, observed_stat, shard)
+                for shard in shards
+            ]
+            count = sum(f.result() for f in futures)
+
+    p_value = count / n_permutations
+    return observed_stat, p_value
+
+
+class StreamingJSD:
+    """
+    Incremental centroid JSD of a growing target sample against a fixed
+    reference. The reference centroid and histogram are computed once;
+    each update projects only the new embeddings and adds their bin
+    counts, so reading the current JSD costs O(new samples).
+    `jsd` always equals SDBPA.calculate_jsd(reference, all_targets_so_far).
+    """
+    def __init__(self, reference, bins=JSD_BINS):
+        self.bins = bins
+        self.mean_ref = np.mean(reference, axis=0)
+        ref_sims = (reference @ self.mean_ref)[None, :]
+        self.ref_counts = histogram_counts(ref_sims, np.ones_like(ref_sims, dtype=bool), bins)
+        self.counts = np.zeros_like(self.ref_counts)
+        self.target_sum = np.zeros_like(self.mean_ref)
+        self.n = 0
+
+    def update(self, embeddings):
+        """
+        Fold new target embeddings in and return the current JSD.
+        """
+        if len(embeddings) == 0:
+            return self.jsd
+        sims = (embeddings @ self.mean_ref)[None, :]
+        self.counts += histogram_counts(sims, np.ones_like(sims, dtype=bool), self.bins)
+        self.target_sum += embeddings.sum(axis=0)
+        self.n += len(embeddings)
+        return self.jsd
+
+    @property
+    def target_mean(self):
+        return self.target_sum / self.n
+
+    @property
+    def jsd(self):
+        if self.n == 0:
+            return float("nan")
+        return float(histogram_jsd(self.ref_counts, self.counts, self.bins)[0])
+
+
+def _multi_target_jsd(grams, counts1, counts2, bins):
+    """
+    Centroid JSD for K pooled Gram matrices (K, n, n) and B group
+    assignments at once -> (K, B). counts1/counts2 (B, n) give each sample's
+    multiplicity in group 1/2: boolean masks for permutations, resample
+    counts for the bootstrap.
+    """
+    n_targets = grams.shape[0]
+    n_rows = len(counts1)
+    weights = counts1.astype(grams.dtype)
+    weights /= weights.sum(axis=1, keepdims=True)
+    sims = (weights @ grams).reshape(n_targets * n_rows, -1)
+
+    hists = []
+    for counts in (counts1, counts2):
+        stacked = np.broadcast_to(counts, (n_targets,) + counts.shape).reshape(sims.shape)
+        if counts.dtype == bool:
+            hists.append(histogram_counts(sims, stacked, bins))
+        else:
+            hists.append(histogram_counts(sims, stacked > 0, bins, weights=stacked))
+    return histogram_jsd(hists[0], hists[1], bins).reshape(n_targets, n_rows)
+
+
+def _target_groups(targets):
+    # Stack targets of equal size so each group is one array pass
+    groups = {}
+    for name, emb in targets.items():
+        groups.setdefault(len(emb), []).append(name)
+    return groups
+
+
+def _stacked_grams(reference, ref_gram, stacked):
+    # Pooled Gram matrices of [reference; target_k] for every stacked target
+    n_ref = len(reference)
+    n = n_ref + stacked.shape[1]
+    cross = reference @ stacked.transpose(0, 2, 1)
+    grams = np.empty((len(stacked), n, n), dtype=cross.dtype)
+    grams[:, :n_ref, :n_ref] = ref_gram
+    grams[:, :n_ref, n_ref:] = cross
+    grams[:, n_ref:, :n_ref] = cross.transpose(0, 2, 1)
+    grams[:, n_ref:, n_ref:] = stacked @ stacked.transpose(0, 2, 1)
+    return grams
+
+
+def multi_target_jsd(reference, targets, bins=JSD_BINS):
+    """
+    Observed centroid JSD of one reference against many targets, no
+    permutations. Returns {name: jsd}.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    n_ref = len(reference)
+    ref_gram = reference @ reference.T
+
+    results = {}
+    for n_target, names in _target_groups(targets).items():
+        stacked = np.stack([targets[name] for name in names]).astype(np.float64)
+        grams = _stacked_grams(reference, ref_gram, stacked)
+        observed_mask = (np.arange(n_ref + n_target) < n_ref)[None, :]
+        observed = _multi_target_jsd(grams, observed_mask, ~observed_mask, bins)[:, 0]
+        for i, name in enumerate(names):
+            results[name] = float(observed[i])
+
+    return {name: results[name] for name in targets}
+
+
+def variant_contributions(reference, target, sources, bins=JSD_BINS):
+    """
+    Break the JSD of `target` against `reference` down by source variant.
+    `sources` holds the variant of each target row (None if unknown).
+    For every variant: its own JSD against the reference ("jsd_alone"), the
+    JSD with that variant left out ("jsd_without"), and the contribution
+    jsd(all) - jsd_without. All subsets are scored in batched passes.
+    Returns {variant: {"n", "jsd_alone", "jsd_without", "contribution"}}.
+    """
+    sources = np.asarray(sources, dtype=object)
+    variants = [v for v in dict.fromkeys(sources.tolist()) if v is not None]
+
+    alone = {v: target[sources == v] for v in variants}
+    without = {v: target[sources != v] for v in variants}
+    jsd_all = multi_target_jsd(reference, {"all": target}, bins)["all"]
+    jsd_alone = multi_target_jsd(reference, alone, bins)
+    jsd_without = multi_target_jsd(reference, without, bins)
+
+    return {
+        v: {
+            "n": len(alone[v]),
+            "jsd_alone": jsd_alone[v],
+            "jsd_without": jsd_without[v],
+            "contribution": jsd_all - jsd_without[v],
+        }
+        for v in variants
+    }
+
+
+def multi_target_permutation_test(reference, targets, n_permutations=1000,
+                                  chunk_size=DEFAULT_CHUNK_SIZE, seed=None,
+                                  bins=JSD_BINS):
+    """
+    Test one reference sample against many targets in a single pass.
+    `targets` maps a name to an embedding matrix. The reference Gram block
+    is computed once, the reference/target cross blocks in one matmul, and
+    every permutation chunk is scored for all targets of the same size at once.
+
+    Each target sees the same per-chunk permutation streams as
+    batched_permutation_test(..., statistic=GramCentroidJSD) with the same
+    seed and chunk_size. Memory per chunk is ~ len(targets) * chunk_size * n.
+
+    Returns {name: {"jsd", "p_value", "n"}}, the row format of
+    results/robustness_results.json.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    n_ref = len(reference)
+    ref_gram = reference @ reference.T
+
+    sizes = [min(chunk_size, n_permutations - start)
+             for start in range(0, n_permutations, chunk_size)]
+    chunk_seeds = _as_seed_sequence(seed).spawn(len(sizes))
+
+    results = {}
+    for n_target, names in _target_groups(targets).items():
+        stacked = np.stack([targets[name] for name in names]).astype(np.float64)
+        grams = _stacked_grams(reference, ref_gram, stacked)
+        n = n_ref + n_target
+
+        observed_mask = (np.arange(n) < n_ref)[None, :]
+        observed = _multi_target_jsd(grams, observed_mask, ~observed_mask, bins)[:, 0]
+
+        counts = np.zeros(len(names), dtype=int)
+        for chunk_seed, size in zip(chunk_seeds, sizes):
+            masks = permutation_masks(np.random.default_rng(chunk_seed), n, n_ref, size)
+            stats = _multi_target_jsd(grams, masks, ~masks, bins)
+            counts += np.count_nonzero(stats >= observed[:, None], axis=1)
+
+        for i, name in enumerate(names):
+            results[name] = {
+                "jsd": float(observed[i]),
+                "p_value": float(counts[i] / n_permutations),
+                "n": n_target,
+            }
+
+    return {name: results[name] for name in targets}
+
+
+def bootstrap_counts(rng, n, n1, size):
+    """
+    Draw `size` bootstrap resamples of both groups as index matrices.
+    Returns (counts1, counts2), each (size, n): how often sample i appears
+    in the resampled group 1 (rows [0, n1)) and group 2 (rows [n1, n)).
+    """
+    offsets = np.arange(size)[:, None] * n
+    idx1 = rng.integers(0, n1, (size, n1)) + offsets
+    idx2 = rng.integers(n1, n, (size, n - n1)) + offsets
+    counts1 = np.bincount(idx1.ravel(), minlength=size * n).reshape(size, n)
+    counts2 = np.bincount(idx2.ravel(), minlength=size * n).reshape(size, n)
+    return counts1, counts2
+
+
+def multi_target_bootstrap_ci(reference, targets, n_resamples=10000, level=0.95,
+                              interval="percentile", chunk_size=DEFAULT_CHUNK_SIZE,
+                              seed=None, bins=JSD_BINS):
+    """
+    Bootstrap CIs for the centroid JSD of one reference against many
+    targets. Both groups are resampled with replacement as count matrices,
+    and every chunk of resamples is scored for all same-sized targets in one
+    pass over the stacked Gram matrices (see multi_target_permutation_test).
+
+    interval="percentile" uses the bootstrap quantiles directly. Resampled
+    histograms are spikier, so the plug-in JSD is biased upward under the
+    bootstrap; interval="basic" reflects the quantiles around the observed
+    value (2 * jsd - q) to correct for that shift.
+
+    Returns {name: {"ci_lower", "ci_upper"}}, to be merged into the
+    results/robustness_results.json rows.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    n_ref = len(reference)
+    ref_gram = reference @ reference.T
+
+    sizes = [min(chunk_size, n_resamples - start)
+             for start in range(0, n_resamples, chunk_size)]
+    chunk_seeds = _as_seed_sequence(seed).spawn(len(sizes))
+    tail = (1 - level) / 2
+
+    results = {}
+    for n_target, names in _target_groups(targets).items():
+        stacked = np.stack([targets[name] for name in names]).astype(np.float64)
+        grams = _stacked_grams(reference, ref_gram, stacked)
+        n = n_ref + n_target
+
+        observed_mask = (np.arange(n) < n_ref)[None, :]
+        observed = _multi_target_jsd(grams, observed_mask, ~observed_mask, bins)[:, 0]
+
+        boot_stats = []
+        for chunk_seed, size in zip(chunk_seeds, sizes):
+            rng = np.random.default_rng(chunk_seed)
+            counts1, counts2 = bootstrap_counts(rng, n, n_ref, size)
+            boot_stats.append(_multi_target_jsd(grams, counts1, counts2, bins))
+        boot_stats = np.concatenate(boot_stats, axis=1)
+
+        lower, upper = np.quantile(boot_stats, [tail, 1 - tail], axis=1)
+        if interval == "basic":
+            lower, upper = np.maximum(2 * observed - upper, 0), 2 * observed - lower
+        elif interval != "percentile":
+            raise ValueError(f"Unknown bootstrap interval: {interval}")
+        for i, name in enumerate(names):
+            results[name] = {
+                "ci_lower": float(lower[i]),
+                "ci_upper": float(upper[i]),
+            }
+
+    return {name: results[name] for name in targets}
+
+
+def asymptotic_test(emb1, emb2, statistic="mmd"):
+    """
+    Permutation-free p-value for kernel statistics ("mmd", "energy"; any
+    statistic exposing a `kernel` matrix whose V-statistic it is).
+    Under H0 the biased MMD^2 behaves like (1/n1 + 1/n2) * sum_l lambda_l Z_l^2,
+    lambda_l the eigenvalues of the centered kernel. Its mean and variance are
+    estimated from the doubly-centered pooled kernel matrix Kc:
+        mean = (1/n1 + 1/n2) * tr(Kc) / n
+        var  = 2 * (1/n1 + 1/n2)^2 * sum_{i != j} Kc_ij^2 / (n (n - 1))
+    and matched to a Gamma distribution (Gretton et al., 2009).
+    Returns (observed_stat, p_value).
+    """
+    combined = np.concatenate([emb1, emb2], axis=0)
+    n = len(combined)
+    n1 = len(emb1)
+    n2 = n - n1
+    stat = build_statistic(statistic, PooledSample(combined))
+    if not hasattr(stat, "kernel"):
+        raise ValueError(f"No asymptotic null available for statistic: {statistic}")
+
+    observed_mask = (np.arange(n) < n1)[None, :]
+    observed_stat = stat(observed_mask)[0]
+
+    kernel = stat.kernel
+    row_means = kernel.mean(axis=1)
+    centered = kernel - row_means[:, None] - row_means[None, :] + kernel.mean()
+
+    scale = 1 / n1 + 1 / n2
+    null_mean = scale * np.trace(centered) / n
+    # Off-diagonal only: the diagonal estimates E[k(x, x)^2], not sum lambda^2
+    off_diag_sq = (centered ** 2).sum() - (np.diag(centered) ** 2).sum()
+    null_var = 2 * scale ** 2 * off_diag_sq / (n * (n - 1))
+
+    shape = null_mean ** 2 / null_var
+    theta = null_var / null_mean
+    p_value = float(gamma.sf(observed_stat, shape, scale=theta))
+    return observed_stat, p_value
+
+
+def calibrate_asymptotic(pairs, statistic="mmd", n_permutations=1000, alpha=0.05,
+                         seed=None):
+    """
+    Compare asymptotic_test against the permutation test on a calibration set.
+    `pairs` maps a name to an (emb1, emb2) tuple. Returns (rows, summary):
+    per-pair p-values and absolute deviation, and the mean/max deviation and
+    the fraction of pairs where both modes agree on p < alpha.
+    """
+    rows = {}
+    for name, (emb1, emb2) in pairs.items():
+        _, p_fast = asymptotic_test(emb1, emb2, statistic=statistic)
+        _, p_perm = batched_permutation_test(
+            emb1, emb2, n_permutations=n_permutations, seed=seed, statistic=statistic
+        )
+        rows[name] = {
+            "p_asymptotic": p_fast,
+            "p_permutation": float(p_perm),
+            "abs_deviation": abs(p_fast - float(p_perm)),
+        }
+
+    deviations = np.array([row["abs_deviation"] for row in rows.values()])
+    agree = [
+        (row["p_asymptotic"] < alpha) == (row["p_permutation"] < alpha)
+        for row in rows.values()
+    ]
+    summary = {
+        "mean_abs_deviation": float(deviations.mean()),
+        "max_abs_deviation": float(deviations.max()),
+        "decision_agreement": float(np.mean(agree)),
+    }
+    return rows, summary
+
+
+def clopper_pearson(count, n, delta):
+    """
+    Two-sided (1 - delta) Clopper-Pearson interval for a binomial proportion.
+    """
+    lower = beta.ppf(delta / 2, count, n - count + 1) if count > 0 else 0.0
+    upper = beta.ppf(1 - delta / 2, count + 1, n - count) if count < n else 1.0
+    return float(lower), float(upper)
+
+
+def sequential_permutation_test(emb1, emb2, alpha=0.05, max_permutations=10000,
+                                chunk_size=DEFAULT_CHUNK_SIZE, seed=None,
+                                statistic="jsd", delta=SEQUENTIAL_DELTA,
+                                strata=None, strata_mode="within"):
+    """
+    Early-stopping permutation test.
+    After every chunk, a Clopper-Pearson interval for the exact permutation
+    p-value is computed at level delta / n_looks (a Bonferroni confidence
+    sequence over all looks). Sampling stops as soon as the interval lies
+    entirely below or above alpha, or when max_permutations is spent.
+
+    Returns (observed_stat, p_value, info). info holds the number of
+    permutations used, the p-value bounds and the decision
+    ("reject", "accept" or "undecided").
+    """
+    if isinstance(statistic, (list, tuple)):
+        raise ValueError("Sequential mode takes a single statistic")
+    seed_seq = _as_seed_sequence(seed)
+    stat, sampler, observed_stat = _setup_test(emb1, emb2, statistic, strata, strata_mode)
+
+    n_looks = int(np.ceil(max_permutations / chunk_size))
+    delta_look = delta / n_looks
+
+    count = 0
+    used = 0
+    decision = "undecided"
+    while used < max_permutations:
+        size = min(chunk_size, max_permutations - used)
+        # Same per-chunk streams as batched_permutation_test
+        rng = np.random.default_rng(seed_seq.spawn(1)[0])
+        masks = sampler(rng, size)
+        count += int(np.count_nonzero(stat(masks) >= observed_stat))
+        used += size
+
+        p_lower, p_upper = clopper_pearson(count, used, delta_look)
+        if p_upper < alpha:
+            decision = "reject"
+            break
+        if p_lower > alpha:
+            decision = "accept"
+            break
+
+    p_value = count / used
+    info = {
+        "n_permutations": used,
+        "p_lower": p_lower,
+        "p_upper": p_upper,
+        "decision": decision,
+    }
+    return observed_stat, p_value, info